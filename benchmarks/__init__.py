@@ -0,0 +1,8 @@
+"""
+Offline benchmarks for certstream, see the Benchmarks section of the README.
+
+    python -m benchmarks                   # microbenchmarks and an end-to-end run
+    python -m benchmarks.micro             # parse_ctl_entry, serialize_certificate, add_all_domains
+    python -m benchmarks.e2e --clients 50  # mock CT log -> TransparencyWatcher -> WebServer -> clients
+    python -m benchmarks.mock_log          # just the mock CT log, to point something else at
+"""
@@ -0,0 +1,65 @@
+import argparse
+import json
+import sys
+
+from benchmarks import e2e, micro
+from benchmarks.fixtures import get_entries
+
+# Which direction is worse for everything we compare against a baseline
+LOWER_IS_BETTER = ('latency_p50', 'latency_p99', 'server_cpu_seconds', 'server_rss_mb')
+HIGHER_IS_BETTER = ('certs_per_sec', 'frames_per_sec')
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+
+    for name, seconds in results['micro'].items():
+        previous = baseline.get('micro', {}).get(name)
+        if previous and seconds > previous * (1 + tolerance):
+            found.append("{} went from {:.1f}us to {:.1f}us per call".format(name, previous * 1e6, seconds * 1e6))
+
+    for key in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+        previous, current = baseline.get('e2e', {}).get(key), results['e2e'].get(key)
+        if not previous or current is None:
+            continue
+        if (key in LOWER_IS_BETTER and current > previous * (1 + tolerance)) or \
+                (key in HIGHER_IS_BETTER and current < previous * (1 - tolerance)):
+            found.append("{} went from {:.4g} to {:.4g}".format(key, previous, current))
+
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the certstream microbenchmarks and an end-to-end benchmark")
+    e2e.add_arguments(parser)
+    micro.add_arguments(parser)
+    parser.add_argument('--json', help="also write the results to this file, for use as a later --baseline")
+    parser.add_argument('--baseline', help="results of an earlier --json run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="fraction a result may get worse by before it counts as a regression")
+    args = e2e.finalize_arguments(parser.parse_args())
+
+    results = {
+        "micro": micro.run(get_entries(args.fixtures, args.fixture_count), args.repeat),
+        "e2e": e2e.run(args),
+    }
+
+    print(micro.report(results['micro']))
+    print()
+    print(e2e.report(results['e2e']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    found = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+
+        print()
+        for regression in found:
+            print("REGRESSION: {}".format(regression))
+        print("{} regressions against {}".format(len(found), args.baseline))
+
+    # An incomplete run fails the gate as well, however good its numbers look
+    sys.exit(1 if found or results['e2e']['dropped'] else 0)
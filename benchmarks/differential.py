@@ -0,0 +1,40 @@
+import argparse
+import sys
+
+from certstream import fastparse
+from benchmarks.fixtures import differential_entries, load_entries
+
+OPERATOR_INFORMATION = {"url": "differential.test", "description": "Differential test"}
+
+
+def run(entries):
+    """
+    Parse every entry with both backends and return the (index, construct_json, fast_json) of those where
+    they disagree.
+    """
+    for index, entry in enumerate(entries):
+        entry.setdefault('index', index)
+
+    return fastparse.compare_backends(entries, OPERATOR_INFORMATION)
+
+
+def report(entries, mismatches):
+    lines = [
+        "Mismatch on entry {}:\n  construct: {}\n  fast:      {}".format(index, reference_json, fast_json)
+        for index, reference_json, fast_json in mismatches
+    ]
+    lines.append("Compared {} entries, {} mismatches".format(len(entries), len(mismatches)))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the fast parser backend gives the same output as the construct one")
+    parser.add_argument('--fixtures', help="saved get-entries response to use instead of synthetic certificates")
+    parser.add_argument('--fixture-count', type=int, default=60)
+    args = parser.parse_args()
+
+    entries = load_entries(args.fixtures) if args.fixtures else differential_entries(args.fixture_count)
+    mismatches = run(entries)
+
+    print(report(entries, mismatches))
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,261 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+from certstream.scheduler import PollScheduler
+from certstream.watcher import TransparencyWatcher
+from certstream.webserver import WebServer
+from benchmarks.fixtures import get_entries
+from benchmarks.mock_log import MockLog, add_arguments as add_log_arguments
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+class BenchmarkWatcher(TransparencyWatcher):
+    # Watches nothing but the mock log, from its very first entry so a backlog gets fetched too. It's polled
+    # on a short fixed interval so latency figures are down to certstream rather than the poll schedule.
+    def __init__(self, _loop, log_url):
+        super(BenchmarkWatcher, self).__init__(_loop)
+        self.log_url = log_url
+        self.scheduler = PollScheduler(initial_interval=0.25, min_interval=0.25, max_interval=0.25)
+
+    async def watch_log_list_task(self):
+        self._update_logs([{"url": self.log_url, "description": "Benchmark log"}])
+        await asyncio.gather(*self.log_tasks.values())
+
+    def _resume_position(self, operator_information, tree_size):
+        return 0
+
+
+def _run_server(log_url, port, ready):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    watcher = BenchmarkWatcher(loop, log_url)
+    webserver = WebServer(loop, watcher)
+
+    async def serve():
+        # Everything WebServer.run_server does, minus TLS and owning the loop
+        webserver.mux_stream = asyncio.ensure_future(webserver.mux_ctl_stream())
+        runner = web.AppRunner(webserver.app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    loop.run_until_complete(serve())
+    ready.set()
+    loop.run_until_complete(asyncio.gather(*watcher.get_tasks()))
+
+
+def _process_tree(pid):
+    # The server and any parsing workers it forked
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(entry)) as f:
+                    parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+
+    tree = [pid]
+    for process in tree:
+        tree.extend(child for child, parent in parents.items() if parent == process)
+    return tree
+
+
+def resource_usage(pid):
+    """
+    CPU seconds used so far and current RSS in bytes, summed over pid and its children.
+    """
+    cpu_seconds = 0.0
+    rss = 0
+    for process in _process_tree(pid):
+        try:
+            with open('/proc/{}/stat'.format(process)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open('/proc/{}/statm'.format(process)) as f:
+                resident_pages = int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        # utime and stime, fields 14 and 15 of /proc/<pid>/stat
+        cpu_seconds += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        rss += resident_pages * PAGE_SIZE
+    return cpu_seconds, rss
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def _client(url, target, deadline, probe, results):
+    received = dropped = 0
+    latencies = []
+    first = last = None
+
+    async with aiohttp.ClientSession() as session:
+        async with session.ws_connect(url, max_msg_size=0) as ws:
+            results['connected'] += 1
+            while received + dropped < target:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    message = await ws.receive(timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    break
+
+                if not message.data.startswith('{"message_type": "certificate_update"'):
+                    # A slow client gets told how many certificates it missed, anything else is a heartbeat
+                    if message.data.startswith('{"message_type": "dropped"'):
+                        dropped += json.loads(message.data)['count']
+                    continue
+
+                last = time.time()
+                if first is None:
+                    first = last
+                received += 1
+
+                # Decoding every frame on every client would measure the clients, one is enough for latency
+                if probe:
+                    latencies.append(last - json.loads(message.data)['data']['seen'])
+
+            # Recorded before the close handshake, which waits on the server and has nothing to do with how
+            # fast it delivered
+            results['received'].append(received)
+            results['latencies'].extend(latencies)
+            if first is not None:
+                results['first'] = min(results.get('first', first), first)
+                results['last'] = max(results.get('last', last), last)
+
+
+async def _run(args, loop):
+    mock_log = MockLog(
+        get_entries(args.fixtures, args.fixture_count),
+        initial_size=args.backlog,
+        rate=args.rate,
+        page_size=args.page_size,
+        latency=args.latency,
+    )
+    log_runner, log_url = await mock_log.start()
+
+    ready = multiprocessing.Event()
+    # Not a daemon, as PARSE_WORKERS needs it to be able to start its own pool
+    server = multiprocessing.Process(target=_run_server, args=(log_url, args.port, ready))
+    server.start()
+
+    try:
+        await loop.run_in_executor(None, ready.wait, 30)
+
+        results = {"connected": 0, "received": [], "latencies": []}
+        deadline = time.monotonic() + args.timeout
+        url = "http://127.0.0.1:{}/{}".format(args.port, "lite" if args.stream == 'lite' else "")
+
+        clients = [
+            asyncio.ensure_future(_client(url, args.entries, deadline, index == 0, results))
+            for index in range(args.clients)
+        ]
+        while results['connected'] < args.clients and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+        # Only now let the log start handing out entries, so every client sees all of them
+        cpu_before, _ = resource_usage(server.pid)
+        started = time.monotonic()
+        mock_log.begin()
+        while len(results['received']) < args.clients and not all(client.done() for client in clients):
+            await asyncio.sleep(0.05)
+        elapsed = time.monotonic() - started
+        cpu_after, rss = resource_usage(server.pid)
+
+        # A client can't finish its close handshake while the server keeps streaming at it, so the server
+        # goes first
+        server.terminate()
+        await asyncio.gather(*clients, return_exceptions=True)
+
+    finally:
+        server.terminate()
+        await log_runner.cleanup()
+
+    delivery_span = results['last'] - results['first'] if 'first' in results else 0
+    delivered = min(results['received']) if results['received'] else 0
+    # Whatever a client didn't receive counts, whether the server told it about the drop, it timed out
+    # waiting or it never got as far as recording anything
+    dropped = args.clients * args.entries - sum(results['received'])
+
+    return {
+        "clients": args.clients,
+        "entries": args.entries,
+        "delivered_per_client": delivered,
+        "dropped": dropped,
+        "certs_per_sec": delivered / delivery_span if delivery_span else 0,
+        "frames_per_sec": sum(results['received']) / delivery_span if delivery_span else 0,
+        "latency_p50": percentile(results['latencies'], 0.5),
+        "latency_p99": percentile(results['latencies'], 0.99),
+        "server_cpu_seconds": cpu_after - cpu_before,
+        "server_cpu_percent": 100 * (cpu_after - cpu_before) / elapsed if elapsed else 0,
+        "server_rss_mb": rss / 1024 / 1024,
+    }
+
+
+def run(args):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(_run(args, loop))
+    finally:
+        loop.close()
+
+
+def report(results):
+    lines = ["end to end ({clients} clients, {entries} certificates)".format(**results)]
+    lines.append("  delivered per client  {}".format(results['delivered_per_client']))
+    lines.append("  dropped (all clients) {}".format(results['dropped']))
+    lines.append("  certs/sec             {:.0f}".format(results['certs_per_sec']))
+    lines.append("  frames/sec            {:.0f}".format(results['frames_per_sec']))
+    for key in ('latency_p50', 'latency_p99'):
+        value = results[key]
+        lines.append("  {:<21} {}".format(key.replace('_', ' '), "{:.1f} ms".format(value * 1000) if value is not None else "n/a"))
+    lines.append("  server cpu            {:.1f}s ({:.0f}%)".format(results['server_cpu_seconds'], results['server_cpu_percent']))
+    lines.append("  server rss            {:.1f} MB".format(results['server_rss_mb']))
+    if results['dropped']:
+        lines.append("WARNING: {} of {} certificates were never delivered, these figures are for an incomplete run".format(
+            results['dropped'], results['clients'] * results['entries']
+        ))
+    return '\n'.join(lines)
+
+
+def add_arguments(parser):
+    add_log_arguments(parser)
+    parser.add_argument('--clients', type=int, default=10, help="simulated websocket clients")
+    parser.add_argument('--entries', type=int, default=2000, help="certificates every client has to receive")
+    parser.add_argument('--backlog', type=int, default=None, help="entries already in the log when we start (defaults to --entries)")
+    parser.add_argument('--rate', type=float, default=0, help="entries appended to the log per second after that")
+    parser.add_argument('--stream', choices=('full', 'lite'), default='full')
+    parser.add_argument('--port', type=int, default=8095, help="port the certstream server listens on")
+    parser.add_argument('--timeout', type=float, default=120, help="give up on clients after this many seconds")
+
+
+def finalize_arguments(args):
+    if args.backlog is None:
+        args.backlog = 0 if args.rate else args.entries
+    return args
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark a mock CT log through TransparencyWatcher and WebServer to websocket clients")
+    add_arguments(parser)
+    results = run(finalize_arguments(parser.parse_args()))
+    print(report(results))
+    sys.exit(1 if results['dropped'] else 0)
@@ -0,0 +1,207 @@
+import base64
+import datetime
+import json
+import random
+import struct
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from OpenSSL import crypto
+
+# DER tags of the ASN.1 string types names are written in
+UTF8_STRING, PRINTABLE_STRING, T61_STRING, IA5_STRING = 0x0c, 0x13, 0x14, 0x16
+
+# Subjects differential_entries() cycles through, each written with a particular ASN.1 string type. The
+# fast parser reads the first few itself and hands the rest (non-ASCII UTF8String, attributes it doesn't
+# know) to certlib, so between them they cover both paths.
+LATIN1_PLACEHOLDER = b'Soci?t? G?n?rale'
+DIFFERENTIAL_SUBJECTS = (
+    [(NameOID.COUNTRY_NAME, "US", PRINTABLE_STRING), (NameOID.COMMON_NAME, "{domain}", PRINTABLE_STRING)],
+    # T61Strings are written as UTF-8 and the placeholder swapped for latin-1 bytes afterwards
+    [(NameOID.ORGANIZATION_NAME, LATIN1_PLACEHOLDER.decode('ascii'), T61_STRING), (NameOID.COMMON_NAME, "{domain}", T61_STRING)],
+    [(NameOID.ORGANIZATION_NAME, "Zürich Straße AG", UTF8_STRING), (NameOID.COMMON_NAME, "{domain}", UTF8_STRING)],
+    [
+        (NameOID.COUNTRY_NAME, "DE", PRINTABLE_STRING),
+        (NameOID.STATE_OR_PROVINCE_NAME, "Berlin", UTF8_STRING),
+        (NameOID.LOCALITY_NAME, "Berlin", UTF8_STRING),
+        (NameOID.ORGANIZATION_NAME, "Example GmbH", UTF8_STRING),
+        (NameOID.ORGANIZATIONAL_UNIT_NAME, "IT", UTF8_STRING),
+        (NameOID.COMMON_NAME, "{domain}", UTF8_STRING),
+        (NameOID.EMAIL_ADDRESS, "hostmaster@{domain}", IA5_STRING),
+    ],
+    [(NameOID.PSEUDONYM, "unknown to the fast parser", UTF8_STRING), (NameOID.COMMON_NAME, "{domain}", UTF8_STRING)],
+)
+
+# Validity periods as (not before, not after). Dates from 2050 on are GeneralizedTime, the rest UTCTime.
+DIFFERENTIAL_VALIDITY = (
+    (datetime.datetime(2017, 7, 14, 2, 40), datetime.datetime(2017, 10, 12, 2, 40)),
+    (datetime.datetime(2020, 1, 1), datetime.datetime(2051, 1, 1)),
+    (datetime.datetime(2050, 6, 30, 23, 59, 59), datetime.datetime(2060, 2, 29, 12)),
+)
+
+
+def _make_certificate(common_name, key, issuer=None, issuer_key=None, sans=(), ca=False, organization=None):
+    certificate = crypto.X509()
+    certificate.set_version(2)
+    certificate.set_serial_number(random.getrandbits(120))
+
+    subject = certificate.get_subject()
+    subject.C = "US"
+    if organization:
+        subject.O = organization
+    subject.CN = common_name
+
+    certificate.gmtime_adj_notBefore(-86400)
+    certificate.gmtime_adj_notAfter(86400 * 90)
+    certificate.set_issuer((issuer or certificate).get_subject())
+    certificate.set_pubkey(key)
+
+    extensions = [
+        crypto.X509Extension(b'basicConstraints', True, b'CA:TRUE' if ca else b'CA:FALSE'),
+        crypto.X509Extension(b'keyUsage', True, b'keyCertSign, cRLSign' if ca else b'digitalSignature, keyEncipherment'),
+    ]
+    if sans:
+        extensions.append(crypto.X509Extension(b'subjectAltName', False, ', '.join('DNS:' + san for san in sans).encode('ascii')))
+    certificate.add_extensions(extensions)
+
+    certificate.sign(issuer_key or key, 'sha256')
+    return certificate
+
+
+def _u24(data):
+    return struct.pack('>I', len(data))[1:] + data
+
+
+def _entry(leaf, chain, precert, timestamp):
+    leaf_der = crypto.dump_certificate(crypto.FILETYPE_ASN1, leaf)
+    chain_der = b''.join(_u24(crypto.dump_certificate(crypto.FILETYPE_ASN1, certificate)) for certificate in chain)
+
+    if precert:
+        # Nothing reads the TBSCertificate in the leaf input, the precertificate itself comes from extra_data
+        leaf_input = struct.pack('>BBQH', 0, 0, timestamp, 1) + b'\x00' * 32 + _u24(leaf_der[4:200]) + b'\x00\x00'
+        extra_data = _u24(leaf_der) + _u24(chain_der)
+    else:
+        leaf_input = struct.pack('>BBQH', 0, 0, timestamp, 0) + _u24(leaf_der) + b'\x00\x00'
+        extra_data = _u24(chain_der)
+
+    return {
+        "leaf_input": base64.b64encode(leaf_input).decode('ascii'),
+        "extra_data": base64.b64encode(extra_data).decode('ascii'),
+    }
+
+
+def synthetic_entries(count=200, seed=0):
+    """
+    Build count get-entries style entries, alternating X509 and precertificate entries issued by the same
+    intermediate and root, so the chain certificate cache behaves the way it does against a real log.
+    """
+    random.seed(seed)
+
+    # Key generation dominates, so every leaf shares one key
+    root_key, intermediate_key, leaf_key = (crypto.PKey() for _ in range(3))
+    for key in (root_key, intermediate_key, leaf_key):
+        key.generate_key(crypto.TYPE_RSA, 2048)
+
+    root = _make_certificate("Benchmark Root", root_key, ca=True, organization="Benchmark Org")
+    intermediate = _make_certificate("Benchmark Intermediate", intermediate_key, issuer=root, issuer_key=root_key, ca=True, organization="Benchmark Org")
+
+    entries = []
+    for index in range(count):
+        domain = "host{}.example{}.com".format(index, index % 7)
+        sans = [domain, "www." + domain] + ["alt{}.{}".format(alt, domain) for alt in range(index % 4)]
+        leaf = _make_certificate(domain, leaf_key, issuer=intermediate, issuer_key=intermediate_key, sans=sans)
+        entries.append(_entry(leaf, [intermediate, root], precert=bool(index % 2), timestamp=1500000000000 + index))
+
+    return entries
+
+
+def _retag(der, value, tag):
+    """
+    Rewrite the UTF8String cryptography wrote value as (its default for most attributes) to the string
+    type tag. Same length, so the DER stays well formed. The signature doesn't, but nothing here checks it.
+    """
+    encoded = value.encode('utf-8')
+    return der.replace(bytes([UTF8_STRING, len(encoded)]) + encoded, bytes([tag, len(encoded)]) + encoded)
+
+
+def _make_differential_certificate(subject, domain, validity, key, issuer=None, issuer_key=None, sans=(), ca=False):
+    """
+    Returns the certificate's DER along with (name, retags) to pass on as the issuer of the certificates
+    it signs. cryptography can't read back names with latin-1 in them, so the issuer name has to be
+    written the same way as the subject was.
+    """
+    name = x509.Name([x509.NameAttribute(oid, value.format(domain=domain)) for oid, value, _ in subject])
+    retags = [(value.format(domain=domain), tag) for _, value, tag in subject]
+    issuer_name, issuer_retags = issuer if issuer is not None else (name, retags)
+
+    builder = x509.CertificateBuilder().subject_name(name).issuer_name(issuer_name).public_key(key.public_key())
+    builder = builder.serial_number(random.getrandbits(120)).not_valid_before(validity[0]).not_valid_after(validity[1])
+    builder = builder.add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True)
+    if sans:
+        builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(san) for san in sans]), critical=False)
+
+    der = builder.sign(issuer_key or key, hashes.SHA256(), default_backend()).public_bytes(serialization.Encoding.DER)
+    for value, tag in retags + issuer_retags:
+        der = _retag(der, value, tag)
+    der = der.replace(LATIN1_PLACEHOLDER, 'Société Générale'.encode('latin-1'))
+
+    return der, (name, retags)
+
+
+def differential_entries(count=60, seed=0):
+    """
+    Build count entries for comparing the parser backends, covering what the fast parser treats
+    differently: X509 and precertificate entries, UTCTime and GeneralizedTime validity, and subjects in
+    PrintableString, latin-1 T61String, UTF8String and IA5String, including some it leaves to certlib.
+    Leaves are issued by one of several intermediates with those same kinds of subjects, so chain
+    certificates get compared as well.
+    """
+    random.seed(seed)
+
+    # EC keys, as there's no need to match the RSA keys real certificates mostly use here
+    root_key, intermediate_key, leaf_key = (ec.generate_private_key(ec.SECP256R1(), default_backend()) for _ in range(3))
+
+    root, root_name = _make_differential_certificate(
+        [(NameOID.COMMON_NAME, "Differential Root", UTF8_STRING)], None, DIFFERENTIAL_VALIDITY[1], root_key, ca=True
+    )
+    intermediates = [
+        _make_differential_certificate(
+            subject, "Differential Intermediate {}".format(index), validity, intermediate_key,
+            issuer=root_name, issuer_key=root_key, ca=True
+        )
+        for index, (subject, validity) in enumerate(zip(DIFFERENTIAL_SUBJECTS, DIFFERENTIAL_VALIDITY[1:] * 3))
+    ]
+
+    entries = []
+    for index in range(count):
+        domain = "host{}.example{}.com".format(index, index % 7)
+        intermediate, intermediate_name = intermediates[index // len(DIFFERENTIAL_SUBJECTS) % len(intermediates)]
+        leaf, _ = _make_differential_certificate(
+            DIFFERENTIAL_SUBJECTS[index % len(DIFFERENTIAL_SUBJECTS)], domain, DIFFERENTIAL_VALIDITY[index % len(DIFFERENTIAL_VALIDITY)],
+            leaf_key, issuer=intermediate_name, issuer_key=intermediate_key, sans=[domain, "www." + domain]
+        )
+
+        chain = [crypto.load_certificate(crypto.FILETYPE_ASN1, der) for der in (intermediate, root)]
+        entries.append(_entry(crypto.load_certificate(crypto.FILETYPE_ASN1, leaf), chain, precert=bool(index % 2), timestamp=1500000000000 + index))
+
+    return entries
+
+
+def load_entries(path):
+    # Either a saved get-entries response or a bare list of its entries
+    with open(path) as f:
+        entries = json.load(f)
+
+    if isinstance(entries, dict):
+        entries = entries['entries']
+
+    return [{"leaf_input": entry['leaf_input'], "extra_data": entry['extra_data']} for entry in entries]
+
+
+def get_entries(path=None, count=200):
+    if path:
+        return load_entries(path)
+    return synthetic_entries(count)
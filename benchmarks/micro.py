@@ -0,0 +1,82 @@
+import argparse
+import base64
+import copy
+import timeit
+
+from OpenSSL import crypto
+
+from certstream import certlib, fastparse
+from benchmarks.fixtures import get_entries
+
+OPERATOR_INFORMATION = {"url": "benchmark.test", "description": "Benchmark log"}
+
+
+def _leaf_der(entry):
+    # X509 entries carry the leaf in leaf_input right after the 12 byte header and its 3 byte length,
+    # precertificate entries (type 1) don't have one there
+    leaf_input = base64.b64decode(entry['leaf_input'])
+    if leaf_input[10:12] != b'\x00\x00':
+        return None
+    length = int.from_bytes(leaf_input[12:15], 'big')
+    return leaf_input[15:15 + length]
+
+
+def time_per_call(function, items, repeat):
+    """
+    Best of repeat passes over items, in seconds per call.
+    """
+    def run_pass():
+        for item in items:
+            function(item)
+
+    return min(timeit.repeat(run_pass, number=1, repeat=repeat)) / len(items)
+
+
+def run(entries, repeat=5):
+    for index, entry in enumerate(entries):
+        entry['index'] = index
+
+    leaf_ders = [der for der in (_leaf_der(entry) for entry in entries) if der is not None]
+
+    parsed = [certlib.parse_ctl_entry(entry, OPERATOR_INFORMATION) for entry in entries]
+    without_domains = []
+    for cert_data in parsed:
+        cert_data = copy.deepcopy(cert_data)
+        cert_data['leaf_cert'].pop('all_domains')
+        without_domains.append(cert_data)
+
+    benchmarks = [
+        ("parse_ctl_entry (construct)", lambda entry: certlib.parse_ctl_entry(entry, OPERATOR_INFORMATION), entries),
+        ("parse_ctl_entry (fast)", lambda entry: fastparse.parse_ctl_entry(entry, OPERATOR_INFORMATION), entries),
+        # Both start from DER, as that's what comes out of a log entry
+        ("serialize_certificate (construct)", lambda der: certlib.serialize_certificate(crypto.load_certificate(crypto.FILETYPE_ASN1, der)), leaf_ders),
+        ("serialize_certificate (fast)", fastparse.serialize_certificate, leaf_ders),
+        ("add_all_domains", certlib.add_all_domains, without_domains),
+    ]
+
+    results = {}
+    for name, function, items in benchmarks:
+        results[name] = time_per_call(function, items, repeat)
+
+    return results
+
+
+def report(results):
+    lines = ["{:<36} {:>12} {:>12}".format("microbenchmark", "us/call", "calls/sec")]
+    for name, seconds in results.items():
+        lines.append("{:<36} {:>12.1f} {:>12.0f}".format(name, seconds * 1e6, 1 / seconds))
+    return '\n'.join(lines)
+
+
+def add_arguments(parser):
+    parser.add_argument('--repeat', type=int, default=5, help="passes over the fixtures, the best one is reported")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmark the certificate parsing hot path")
+    parser.add_argument('--fixtures', help="saved get-entries response to use instead of synthetic certificates")
+    parser.add_argument('--fixture-count', type=int, default=200)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    print(report(run(get_entries(args.fixtures, args.fixture_count), args.repeat)))
@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import time
+
+from aiohttp import web
+
+from benchmarks.fixtures import get_entries
+
+
+class MockLog(object):
+    """
+    Stand-in CT log serving get-sth and get-entries out of a list of fixture entries, repeated as often as
+    needed. The tree is empty until begin() is called, from then on it's initial_size entries big and
+    grows by rate entries a second. get-entries hands back at most page_size entries per request, after
+    an optional artificial latency.
+    """
+    def __init__(self, entries, initial_size=0, rate=0, page_size=1024, latency=0):
+        self.entries = entries
+        self.initial_size = initial_size
+        self.rate = rate
+        self.page_size = page_size
+        self.latency = latency
+
+        self.started = None
+        self.sth_requests = 0
+        self.entries_requests = 0
+        self.entries_served = 0
+
+    def begin(self):
+        self.started = time.monotonic()
+
+    def tree_size(self):
+        if self.started is None:
+            return 0
+        return self.initial_size + int((time.monotonic() - self.started) * self.rate)
+
+    async def get_sth(self, _):
+        self.sth_requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        return web.json_response({
+            "tree_size": self.tree_size(),
+            "timestamp": int(time.time() * 1000),
+            "sha256_root_hash": "",
+            "tree_head_signature": "",
+        })
+
+    async def get_entries(self, request):
+        self.entries_requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        try:
+            start, end = int(request.query['start']), int(request.query['end'])
+        except (KeyError, ValueError):
+            return web.json_response({"error_message": "Missing or invalid start and end"}, status=400)
+
+        end = min(end, start + self.page_size - 1, self.tree_size() - 1)
+        if start < 0 or start > end:
+            return web.json_response({"error_message": "Invalid range {}-{}".format(start, end)}, status=400)
+
+        self.entries_served += end - start + 1
+
+        return web.json_response({
+            "entries": [self.entries[index % len(self.entries)] for index in range(start, end + 1)]
+        })
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/ct/v1/get-sth', self.get_sth)
+        app.router.add_get('/ct/v1/get-entries', self.get_entries)
+        return app
+
+    async def start(self, host='127.0.0.1', port=0):
+        """
+        Serve the log and return (runner, url), with url ready to be used as a log list entry.
+        """
+        runner = web.AppRunner(self.make_app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+
+        # Port 0 picks a free one, find out which
+        port = runner.addresses[0][1]
+
+        return runner, "http://{}:{}".format(host, port)
+
+
+def add_arguments(parser):
+    parser.add_argument('--fixtures', help="saved get-entries response to serve instead of synthetic certificates")
+    parser.add_argument('--fixture-count', type=int, default=200, help="number of distinct synthetic certificates")
+    parser.add_argument('--page-size', type=int, default=1024, help="most entries returned by one get-entries")
+    parser.add_argument('--latency', type=float, default=0, help="seconds added to every request")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a mock CT log")
+    add_arguments(parser)
+    parser.add_argument('--initial-size', type=int, default=0)
+    parser.add_argument('--rate', type=float, default=100, help="entries appended per second")
+    parser.add_argument('--port', type=int, default=8090)
+    args = parser.parse_args()
+
+    mock_log = MockLog(
+        get_entries(args.fixtures, args.fixture_count),
+        initial_size=args.initial_size,
+        rate=args.rate,
+        page_size=args.page_size,
+        latency=args.latency,
+    )
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    _, url = loop.run_until_complete(mock_log.start(port=args.port))
+    mock_log.begin()
+    print("Mock CT log serving on {}".format(url))
+    loop.run_forever()
@@ -1,4 +1,5 @@
 import logging
+import os
 
 import asyncio
 
@@ -6,17 +7,46 @@ import uvloop
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 from certstream.certlib import MerkleTreeHeader
+from certstream.metrics import serve_metrics
+from certstream.relay import FramePublisher, RelayWatcher
+from certstream.util import run_until_signalled
 from certstream.watcher import TransparencyWatcher
 from certstream.webserver import WebServer
+from certstream.workers import WorkerSupervisor
 
 logging.basicConfig(format='[%(levelname)s:%(name)s] %(asctime)s - %(message)s', level=logging.INFO)
 
 def run():
-    logging.info("Starting CertStream...")
+    # standalone does everything in one process, ingest only polls the logs and publishes frames to edge
+    # nodes, and edge only serves websockets from what an ingest node publishes
+    role = os.getenv("CERTSTREAM_ROLE", "standalone")
+
+    logging.info("Starting CertStream ({})...".format(role))
+
+    # Several websocket workers sharing the port, the supervisor forks them before creating its own loop
+    worker_count = int(os.getenv("WEB_WORKERS", 1))
+    if role == "standalone" and worker_count > 1:
+        WorkerSupervisor(worker_count).run()
+        return
 
     loop = asyncio.get_event_loop()
 
-    watcher = TransparencyWatcher(loop)
+    if role == "ingest":
+        watcher = TransparencyWatcher(loop)
+        publisher = FramePublisher(loop, watcher)
+        try:
+            run_until_signalled(loop, publisher.get_tasks() + watcher.get_tasks() + [serve_metrics(loop)])
+        finally:
+            watcher.checkpoints.flush()
+        return
+
+    if role == "edge":
+        watcher = RelayWatcher(loop)
+    elif role == "standalone":
+        watcher = TransparencyWatcher(loop)
+    else:
+        raise ValueError("Unknown CERTSTREAM_ROLE {}, expected standalone, ingest or edge".format(role))
+
     webserver = WebServer(loop, watcher)
 
     asyncio.ensure_future(asyncio.gather(*watcher.get_tasks()))
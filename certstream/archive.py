@@ -0,0 +1,469 @@
+import json
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+from certstream import metrics
+from certstream.filters import parse_pattern
+from certstream.util import atomic_write
+
+# Every archived certificate is the length of its compressed frame, the length of its domain list and when
+# it was seen, followed by the newline separated domains and then the zlib compressed full frame
+RECORD_HEADER = struct.Struct('>IId')
+
+SEARCHABLE_PATTERN_TYPES = ('exact', 'suffix', 'subdomain')
+
+
+def _index_key(domain):
+    # Labels reversed, so everything under a domain sorts together right after it: "www.example.com" is
+    # keyed as "com.example.www". The trailing space ends the key on both exact and prefix lookups.
+    return '.'.join(reversed(domain.lower().strip('.').split('.'))).encode('utf-8') + b' '
+
+
+def search_prefixes(pattern):
+    """
+    The index key prefixes a domain pattern (in the same syntax as the websocket domain filters) has to be
+    looked up under. Only patterns anchored on a domain can use the index.
+    """
+    pattern_type, domain = parse_pattern(pattern)
+    if pattern_type not in SEARCHABLE_PATTERN_TYPES:
+        raise ValueError("Only exact, suffix and subdomain patterns can be searched, not {!r}".format(pattern))
+
+    key = _index_key(domain)
+    prefixes = []
+    if pattern_type in ('exact', 'suffix'):
+        prefixes.append(key)
+    if pattern_type in ('subdomain', 'suffix'):
+        prefixes.append(key[:-1] + b'.')
+    return prefixes
+
+
+def _lower_bound(mm, start, prefix):
+    # Binary search over the sorted, newline terminated lines of mm from start on, for the first line that
+    # doesn't sort before prefix. start always follows a newline.
+    low, high = start, len(mm)
+    while low < high:
+        middle = (low + high) // 2
+        line_start = mm.rfind(b'\n', start - 1, middle) + 1
+        line_end = mm.find(b'\n', middle)
+        if mm[line_start:line_end] < prefix:
+            low = line_end + 1
+        else:
+            high = line_start
+    return low
+
+
+class _Segment(object):
+    """
+    One append-only file of archived certificates, named after its place in the archive. While it's being
+    written to, its domain index is a list in memory. Once sealed, the index is written out next to it as
+    a metadata line followed by sorted "key offset" lines, and both files are searched through mmap
+    without loading either of them.
+    """
+    def __init__(self, directory, segment_id):
+        self.segment_id = segment_id
+        self.path = os.path.join(directory, "{:08d}.seg".format(segment_id))
+        self.index_path = os.path.join(directory, "{:08d}.idx".format(segment_id))
+
+        self.count = 0
+        self.size_bytes = 0
+        self.first_seen = None
+        self.last_seen = None
+        self.sealed = False
+
+        self.keys = []
+        self._mmap = None
+        self._index_mmap = None
+        self._index_start = 0
+
+    def load(self):
+        """
+        Pick up a segment already on disk. Returns False if there's a torn record at the end of it (from a
+        crash mid-write), which is left out.
+        """
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                metadata = json.loads(f.readline().decode('utf-8'))
+            self.count = metadata['count']
+            self.first_seen = metadata['first_seen']
+            self.last_seen = metadata['last_seen']
+            self.size_bytes = os.path.getsize(self.path)
+            self.sealed = True
+            return True
+
+        return self.scan()
+
+    def scan(self):
+        """
+        Index whatever has been appended since we last looked, for segments somebody else is writing.
+        """
+        with open(self.path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            f.seek(self.size_bytes)
+
+            while self.size_bytes + RECORD_HEADER.size <= file_size:
+                payload_length, domains_length, seen = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                record_size = RECORD_HEADER.size + domains_length + payload_length
+                if self.size_bytes + record_size > file_size:
+                    break
+
+                domains = f.read(domains_length).decode('utf-8')
+                f.seek(payload_length, os.SEEK_CUR)
+
+                self.add(self.size_bytes, record_size, seen, domains.split('\n') if domains else [])
+
+        return self.size_bytes == file_size
+
+    def add(self, offset, record_size, seen, domains):
+        self.count += 1
+        self.size_bytes = offset + record_size
+        if self.first_seen is None:
+            self.first_seen = seen
+        self.last_seen = seen
+        self.keys.extend((_index_key(domain), offset) for domain in domains)
+
+    def seal(self):
+        header = json.dumps({"count": self.count, "first_seen": self.first_seen, "last_seen": self.last_seen}).encode('utf-8') + b'\n'
+        atomic_write(self.index_path, header + b''.join(key + str(offset).encode('ascii') + b'\n' for key, offset in sorted(set(self.keys))))
+
+        self.keys = []
+        self.sealed = True
+        self.close()
+
+    def _map(self):
+        # A segment still being written to grows under us, so it's remapped whenever that happens
+        if self._mmap is None or len(self._mmap) < self.size_bytes:
+            if self._mmap is not None:
+                self._mmap.close()
+            with open(self.path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), self.size_bytes, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _map_index(self):
+        if self._index_mmap is None:
+            with open(self.index_path, 'rb') as f:
+                self._index_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._index_start = self._index_mmap.find(b'\n') + 1
+        return self._index_mmap
+
+    def _offsets(self, prefixes):
+        offsets = set()
+        if not self.sealed:
+            for key, offset in self.keys:
+                if key.startswith(prefixes):
+                    offsets.add(offset)
+            return offsets
+
+        index = self._map_index()
+        for prefix in prefixes:
+            position = _lower_bound(index, self._index_start, prefix)
+            while position < len(index):
+                line_end = index.find(b'\n', position)
+                line = index[position:line_end]
+                if not line.startswith(prefix):
+                    break
+                offsets.add(int(line.rsplit(b' ', 1)[1]))
+                position = line_end + 1
+        return offsets
+
+    def search(self, prefixes, since):
+        """
+        Offsets of the certificates seen since `since` with a domain under one of the prefixes, newest first.
+        """
+        if not self.count or self.last_seen < since:
+            return []
+
+        offsets = sorted(self._offsets(tuple(prefixes)), reverse=True)
+        if not offsets:
+            return []
+
+        mm = self._map()
+        return [offset for offset in offsets if RECORD_HEADER.unpack_from(mm, offset)[2] >= since]
+
+    def read(self, offset):
+        mm = self._map()
+        payload_length, domains_length, _ = RECORD_HEADER.unpack_from(mm, offset)
+        start = offset + RECORD_HEADER.size + domains_length
+        return zlib.decompress(mm[start:start + payload_length]).decode('utf-8')
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._index_mmap is not None:
+            self._index_mmap.close()
+            self._index_mmap = None
+
+    def remove(self):
+        self.close()
+        for path in (self.index_path, self.path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class CertificateArchive(object):
+    """
+    Optional on-disk history of every certificate broadcast, searchable by domain. Certificates are
+    appended compressed to a segment file, which is sealed and indexed once it reaches
+    ARCHIVE_SEGMENT_BYTES or has been open for ARCHIVE_SEGMENT_SECONDS. Whole segments are deleted once
+    they're older than ARCHIVE_RETENTION_HOURS or the archive outgrows ARCHIVE_MAX_BYTES.
+
+    Only one process may write to an archive directory, but any number can search it read only, picking
+    up new segments (and new certificates in the one being written) as they show up.
+
+    None of the disk work happens on the event loop. append() only queues the certificate for a writer
+    thread, which compresses and writes whatever has queued up in one go and does the sealing and
+    retention too. If the writer falls ARCHIVE_QUEUE_SIZE certificates behind, new ones are left out of the
+    archive rather than holding up the broadcast. search() is blocking and meant to be run in an executor.
+    """
+    # Most certificates written by the writer thread in one write
+    MAX_WRITE_BATCH = 1000
+
+    def __init__(self, path=None, read_only=False, segment_bytes=None, segment_seconds=None, retention_hours=None,
+                 max_bytes=None, compression_level=6, queue_size=None):
+        self.logger = logging.getLogger('certstream.archive')
+
+        self.path = path if path is not None else os.getenv("ARCHIVE_DIR")
+        self.read_only = read_only
+        self.segment_bytes = segment_bytes if segment_bytes is not None else int(os.getenv("ARCHIVE_SEGMENT_BYTES", 64 * 1024 * 1024))
+        self.segment_seconds = segment_seconds if segment_seconds is not None else float(os.getenv("ARCHIVE_SEGMENT_SECONDS", 3600))
+        self.retention_hours = retention_hours if retention_hours is not None else float(os.getenv("ARCHIVE_RETENTION_HOURS", 168))
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("ARCHIVE_MAX_BYTES", 0))
+        self.compression_level = compression_level
+
+        # Oldest first, keyed by segment id
+        self.segments = {}
+        self.active = None
+        self.active_file = None
+        self.active_opened = None
+
+        # Held by the writer while it changes which segments there are or what's indexed in them, and by
+        # searches, which all run off the event loop
+        self.lock = threading.RLock()
+        self.queue = queue.Queue(maxsize=queue_size if queue_size is not None else int(os.getenv("ARCHIVE_QUEUE_SIZE", 10000)))
+        self.writer = None
+        self.dropped = 0
+
+        if self.enabled:
+            os.makedirs(self.path, exist_ok=True)
+            self._refresh()
+            if not self.read_only:
+                self._open_active()
+                self.writer = threading.Thread(target=self._write_loop, name='certstream-archive', daemon=True)
+                self.writer.start()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    @property
+    def size_bytes(self):
+        # Copied in one go, as the writer thread may be adding or removing segments
+        return sum(segment.size_bytes for segment in list(self.segments.values()))
+
+    def _segment_ids(self):
+        return sorted(int(name[:-len('.seg')]) for name in os.listdir(self.path) if name.endswith('.seg') and name[:-len('.seg')].isdigit())
+
+    def _refresh(self):
+        segment_ids = self._segment_ids()
+
+        for segment_id in set(self.segments) - set(segment_ids):
+            self.segments.pop(segment_id).close()
+
+        for segment_id in segment_ids:
+            segment = self.segments.get(segment_id)
+            try:
+                if segment is None:
+                    segment = _Segment(self.path, segment_id)
+                    intact = segment.load()
+                    if not intact and not self.read_only:
+                        self.logger.warning("Dropping a torn record at the end of {}".format(segment.path))
+                        os.truncate(segment.path, segment.size_bytes)
+                    self.segments[segment_id] = segment
+                elif not segment.sealed:
+                    if os.path.exists(segment.index_path):
+                        segment.close()
+                        segment = self.segments[segment_id] = _Segment(self.path, segment_id)
+                        segment.load()
+                    else:
+                        segment.scan()
+            except (OSError, ValueError, KeyError) as e:
+                # Most likely deleted by retention under a reader's feet
+                self.logger.info("Skipping archive segment {} -> {}".format(segment_id, e))
+                self.segments.pop(segment_id, None)
+
+    def _open_active(self):
+        unsealed = [segment for segment in self.segments.values() if not segment.sealed]
+
+        # Anything but the newest unsealed segment was cut short by a crash, it gets sealed as it is
+        for segment in unsealed[:-1]:
+            segment.seal()
+
+        if unsealed:
+            self.active = unsealed[-1]
+        else:
+            next_id = max(self.segments) + 1 if self.segments else 0
+            self.active = self.segments[next_id] = _Segment(self.path, next_id)
+
+        self.active_file = open(self.active.path, 'ab')
+        self.active_opened = time.time()
+
+        self.logger.info("Archiving certificates to {} ({} segments, {} bytes)".format(self.path, len(self.segments), self.size_bytes))
+
+    def append(self, message):
+        if self.writer is None:
+            return
+
+        seen = message.seen if message.seen is not None else time.time()
+        try:
+            self.queue.put_nowait((seen, message.all_domains, message.frame()))
+        except queue.Full:
+            if not self.dropped:
+                self.logger.warning("Archive writer can't keep up, leaving certificates out of the archive")
+            self.dropped += 1
+            metrics.ARCHIVE_DROPPED.inc()
+
+    def _write_loop(self):
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not None and len(batch) < self.MAX_WRITE_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # None is how close() tells us to stop, once everything before it is written
+            certificates = [certificate for certificate in batch if certificate is not None]
+            if certificates:
+                try:
+                    self._write(certificates)
+                except Exception:
+                    self.logger.exception("Unable to archive {} certificates".format(len(certificates)))
+
+            if batch[-1] is None:
+                return
+
+    def _write(self, certificates):
+        start = offset = self.active.size_bytes
+        records = []
+        added = []
+        for seen, domains, frame in certificates:
+            domains_data = '\n'.join(domains).encode('utf-8')
+            payload = zlib.compress(frame.encode('utf-8'), self.compression_level)
+            record = RECORD_HEADER.pack(len(payload), len(domains_data), seen) + domains_data + payload
+            records.append(record)
+            added.append((offset, len(record), seen, domains))
+            offset += len(record)
+
+        try:
+            self.active_file.write(b''.join(records))
+            self.active_file.flush()
+        except OSError as e:
+            self.logger.warning("Unable to archive certificates -> {}".format(e))
+            # Put the file back the way it was so a partial record can't throw off every later offset
+            self.active_file.close()
+            os.truncate(self.active.path, start)
+            self.active_file = open(self.active.path, 'ab')
+            return
+
+        # Only indexed once they're actually in the file, so a search never reads past what's there
+        with self.lock:
+            for record in added:
+                self.active.add(*record)
+
+        if self.active.size_bytes >= self.segment_bytes or time.time() - self.active_opened >= self.segment_seconds:
+            self._roll()
+
+    def _roll(self):
+        self.active_file.close()
+
+        with self.lock:
+            try:
+                self.active.seal()
+            except OSError as e:
+                self.logger.warning("Unable to write the index of {} -> {}".format(self.active.path, e))
+
+            next_id = self.active.segment_id + 1
+            self.active = self.segments[next_id] = _Segment(self.path, next_id)
+
+            self._enforce_retention()
+
+        self.active_file = open(self.active.path, 'ab')
+        self.active_opened = time.time()
+
+    def _enforce_retention(self):
+        cutoff = time.time() - self.retention_hours * 3600 if self.retention_hours > 0 else None
+        total_bytes = self.size_bytes
+
+        for segment_id in list(self.segments):
+            segment = self.segments[segment_id]
+            if segment is self.active:
+                break
+
+            expired = cutoff is not None and (segment.last_seen is None or segment.last_seen < cutoff)
+            oversized = self.max_bytes > 0 and total_bytes > self.max_bytes
+            if not expired and not oversized:
+                break
+
+            self.logger.info("Removing archive segment {} ({} certificates, {} bytes)".format(segment.path, segment.count, segment.size_bytes))
+            total_bytes -= segment.size_bytes
+            segment.remove()
+            del self.segments[segment_id]
+
+    def search(self, pattern, since=0, limit=100):
+        """
+        Full frames of the newest `limit` certificates seen since `since` with a domain matching pattern.
+        """
+        prefixes = search_prefixes(pattern)
+
+        with self.lock:
+            if self.read_only:
+                self._refresh()
+
+            frames = []
+            for segment_id in sorted(self.segments, reverse=True):
+                segment = self.segments[segment_id]
+                if segment.last_seen is not None and segment.last_seen < since:
+                    # Segments are in the order certificates came in, so nothing older will match either
+                    break
+
+                for offset in segment.search(prefixes, since):
+                    frames.append(segment.read(offset))
+                    if len(frames) >= limit:
+                        return frames
+
+            return frames
+
+    def stats(self):
+        segments = list(self.segments.values())
+        return {
+            "segments": len(segments),
+            "certificates": sum(segment.count for segment in segments),
+            "bytes": sum(segment.size_bytes for segment in segments),
+            "oldest_seen": min((segment.first_seen for segment in segments if segment.first_seen is not None), default=None),
+            "read_only": self.read_only,
+            "queued": self.queue.qsize(),
+            "dropped": self.dropped,
+        }
+
+    def close(self):
+        """
+        Write out whatever is still queued and stop the writer. Blocks until that's done.
+        """
+        if self.writer is not None:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+
+        if self.active_file is not None:
+            self.active_file.close()
+            self.active_file = None
+        for segment in self.segments.values():
+            segment.close()
@@ -0,0 +1,423 @@
+import argparse
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import signal
+import time
+
+import aiohttp
+
+from certstream import metrics
+from certstream.blocksizes import BlockSizes
+from certstream.util import atomic_write
+
+
+def job_id(log_url, start, end):
+    # The same range of the same log always gets the same id, so asking for it again resumes it
+    return hashlib.sha1("{}:{}:{}".format(log_url, start, end).encode('utf-8')).hexdigest()[:12]
+
+
+class RateLimiter(object):
+    """
+    Spaces requests to one log at least 1 / rate seconds apart, however many fetchers are sharing it. A
+    rate of 0 doesn't limit anything.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_slot = time.monotonic()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        slot = max(self.next_slot, now)
+        self.next_slot = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class NdjsonSink(object):
+    """
+    Appends backfilled certificates to a file, one JSON object per line, in whatever order their chunks
+    finish.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a')
+
+    async def write(self, records):
+        self.file.writelines(record.data_json + '\n' for record in records)
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class ChannelSink(object):
+    """
+    Fans backfilled certificates out to the websocket clients of the backfill channel as backfill_update
+    messages. Rather than letting a slow client drop anything, the backfill waits for the slowest one to
+    get through half of its queue, and pauses altogether while nobody's subscribed.
+    """
+    def __init__(self, clients):
+        self.clients = clients
+
+    @staticmethod
+    def _backed_up(queue):
+        # An empty queue always takes a frame, however small its limits
+        return queue.qsize() >= max(1, queue.max_size // 2) or (queue.max_bytes > 0 and queue.size_bytes >= queue.max_bytes // 2)
+
+    async def write(self, records):
+        for record in records:
+            while not self.clients or any(self._backed_up(client.queue) for client in self.clients):
+                await asyncio.sleep(0.05)
+
+            frame = '{{"message_type": "backfill_update", "data": {}}}'.format(record.data_json)
+            for client in self.clients:
+                client.queue.put_nowait(frame)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class BackfillJob(object):
+    """
+    Fetches entries [start, end) of one log, whatever its current position, and hands them to a sink. The
+    range is cut into chunks that `concurrency` fetchers work through in parallel, each chunk fetched a page
+    at a time and parsed through the watcher's pipeline. How far every chunk has got is written to
+    state_path every few seconds, so a job that's stopped or crashes picks up from there when it's started
+    again with the same state file (anything after the last save is fetched again).
+    """
+    STATE_SAVE_INTERVAL = 5
+
+    def __init__(self, watcher, operator_information, start, end, sink, state_path=None, concurrency=None,
+                 chunk_size=None, rate_limiter=None, max_retries=None):
+        self.logger = logging.getLogger('certstream.backfill')
+
+        self.watcher = watcher
+        self.operator_information = operator_information
+        self.start = start
+        self.end = end
+        self.sink = sink
+        self.state_path = state_path
+        self.id = job_id(operator_information['url'], start, end)
+
+        self.concurrency = concurrency if concurrency is not None else int(os.getenv("BACKFILL_CONCURRENCY", 8))
+        self.chunk_size = chunk_size if chunk_size is not None else int(os.getenv("BACKFILL_CHUNK_SIZE", 8192))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("BACKFILL_MAX_RETRIES", 10))
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter(float(os.getenv("BACKFILL_RATE_LIMIT", 20)))
+
+        # Learnt separately from the live watcher's, so a backfill's pages never change how it polls
+        self.block_sizes = BlockSizes(watcher.MAX_BLOCK_SIZE)
+
+        # Next index to fetch for each chunk, keyed by the chunk's first index
+        self.chunks = collections.OrderedDict(
+            (chunk_start, chunk_start) for chunk_start in range(start, end, self.chunk_size)
+        )
+        self._load_state()
+
+        self.status = 'pending'
+        self.error = None
+        self.errors = 0
+        self.fetched = 0
+        self.started = None
+        self.finished = None
+        self.task = None
+
+    def _load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.warning("Unable to read backfill state {}, starting over -> {}".format(self.state_path, e))
+            return
+
+        if (state.get('log'), state.get('start'), state.get('end'), state.get('chunk_size')) != \
+                (self.operator_information['url'], self.start, self.end, self.chunk_size):
+            self.logger.warning("Backfill state {} is for a different job, starting over".format(self.state_path))
+            return
+
+        for chunk_start, next_index in state['chunks'].items():
+            if int(chunk_start) in self.chunks:
+                self.chunks[int(chunk_start)] = next_index
+
+        self.logger.info("Resuming backfill {} with {} of {} entries already done".format(self.id, self.done, self.total))
+
+    def _save_state(self):
+        if not self.state_path:
+            return
+
+        # Only once the output is on disk, so the state never claims more than has actually been written
+        self.sink.flush()
+
+        try:
+            atomic_write(self.state_path, json.dumps({
+                "log": self.operator_information['url'],
+                "start": self.start,
+                "end": self.end,
+                "chunk_size": self.chunk_size,
+                "chunks": {str(chunk_start): next_index for chunk_start, next_index in self.chunks.items()},
+            }))
+        except OSError as e:
+            self.logger.warning("Unable to write backfill state {} -> {}".format(self.state_path, e))
+
+    @property
+    def total(self):
+        return self.end - self.start
+
+    @property
+    def done(self):
+        return sum(next_index - chunk_start for chunk_start, next_index in self.chunks.items())
+
+    async def run(self):
+        self.status = 'running'
+        self.started = time.monotonic()
+        name = self.operator_information['description']
+
+        self.logger.info("[{}] Backfilling {} -> {} as job {} ({} fetchers)".format(name, self.start, self.end, self.id, self.concurrency))
+
+        remaining = collections.deque(
+            chunk_start for chunk_start, next_index in self.chunks.items()
+            if next_index < min(chunk_start + self.chunk_size, self.end)
+        )
+
+        saver = asyncio.ensure_future(self._save_state_task())
+        fetchers = [asyncio.ensure_future(self._fetcher(remaining)) for _ in range(min(self.concurrency, len(remaining)))]
+        try:
+            await asyncio.gather(*fetchers)
+            self.status = 'complete'
+        except asyncio.CancelledError:
+            self.status = 'cancelled'
+            raise
+        except Exception as e:
+            self.status = 'failed'
+            self.error = str(e)
+            self.logger.warning("[{}] Backfill {} failed -> {}".format(name, self.id, e))
+        finally:
+            for fetcher in fetchers:
+                fetcher.cancel()
+            saver.cancel()
+            self.finished = time.monotonic()
+            self._save_state()
+            self.sink.close()
+
+        self.logger.info("[{}] Backfill {} {} after {:.0f}s, {} of {} entries".format(
+            name, self.id, self.status, self.finished - self.started, self.done, self.total
+        ))
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _save_state_task(self):
+        while True:
+            await asyncio.sleep(self.STATE_SAVE_INTERVAL)
+            self._save_state()
+
+    async def _fetcher(self, remaining):
+        while remaining:
+            chunk_start = remaining.popleft()
+            retries = 0
+            while True:
+                try:
+                    await self._fetch_chunk(chunk_start)
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    self.errors += 1
+                    retries += 1
+                    if retries > self.max_retries:
+                        raise
+                    delay = min(2 ** retries, 60)
+                    self.logger.info("[{}] Backfill chunk {} failed, retrying in {}s -> {}".format(
+                        self.operator_information['description'], chunk_start, delay, e
+                    ))
+                    await asyncio.sleep(delay)
+
+    async def _fetch_chunk(self, chunk_start):
+        chunk_end = min(chunk_start + self.chunk_size, self.end)
+        session = self.watcher._get_session()
+
+        while self.chunks[chunk_start] < chunk_end:
+            next_index = self.chunks[chunk_start]
+            # Ask for no more than the log has been handing back, so pages line up with what it serves
+            page_end = min(next_index + self.block_sizes.get(self.operator_information['url']), chunk_end)
+
+            await self.rate_limiter.acquire()
+            entries = (await self.watcher._fetch_entries(session, self.operator_information, next_index, page_end - 1))[:page_end - next_index]
+            if not entries:
+                raise aiohttp.ClientError("Log returned no entries for {}-{}".format(next_index, page_end - 1))
+
+            # The job's last page may be right up against the tree head, so that one isn't learnt from
+            self.block_sizes.record(self.operator_information['url'], page_end - next_index, len(entries), tail=page_end >= self.end)
+
+            for index, entry in enumerate(entries, next_index):
+                entry['index'] = index
+
+            records = await (await self.watcher.pipeline.submit(entries, self.operator_information))
+            await self.sink.write(records)
+
+            self.chunks[chunk_start] = next_index + len(entries)
+            self.fetched += len(entries)
+            metrics.BACKFILL_ENTRIES.inc(len(entries))
+
+    def progress(self):
+        elapsed = ((self.finished or time.monotonic()) - self.started) if self.started else 0
+        rate = self.fetched / elapsed if elapsed else 0
+        remaining = self.total - self.done
+        return {
+            "id": self.id,
+            "log": self.operator_information['url'],
+            "start": self.start,
+            "end": self.end,
+            "status": self.status,
+            "done": self.done,
+            "total": self.total,
+            "percent": round(100 * self.done / self.total, 2) if self.total else 100.0,
+            "entries_per_sec": round(rate, 1),
+            "eta_seconds": round(remaining / rate) if rate and self.status == 'running' else None,
+            "errors": self.errors,
+            "error": self.error,
+        }
+
+
+class Backfiller(object):
+    """
+    Runs backfill jobs alongside a watcher, sharing its session, request limits and parsing pipeline, with
+    one rate limiter per log however many jobs are running against it.
+    """
+    def __init__(self, watcher, directory=None, rate_limit=None):
+        self.logger = logging.getLogger('certstream.backfill')
+        self.watcher = watcher
+        self.directory = directory if directory is not None else os.getenv("BACKFILL_DIR", "backfill")
+        self.rate_limit = rate_limit if rate_limit is not None else float(os.getenv("BACKFILL_RATE_LIMIT", 20))
+
+        self.jobs = collections.OrderedDict()
+        self.rate_limiters = {}
+
+    def operator_information(self, log_url):
+        log_url = log_url.rstrip('/')
+        for log in self.watcher.transparency_logs['logs']:
+            if log['url'] == log_url:
+                return log
+        return {"url": log_url, "description": log_url}
+
+    def start(self, log_url, start, end, sink=None, concurrency=None):
+        """
+        Start (or resume) backfilling [start, end) of a log. Without a sink the certificates go to
+        BACKFILL_DIR/<job id>.ndjson. Asking for a job that's already running returns it as is.
+        """
+        if start < 0 or end <= start:
+            raise ValueError("Backfill range must have 0 <= start < end, got {}-{}".format(start, end))
+
+        operator_information = self.operator_information(log_url)
+        backfill_id = job_id(operator_information['url'], start, end)
+
+        job = self.jobs.get(backfill_id)
+        if job is not None and job.status in ('pending', 'running'):
+            return job
+
+        os.makedirs(self.directory, exist_ok=True)
+        if sink is None:
+            sink = NdjsonSink(os.path.join(self.directory, "{}.ndjson".format(backfill_id)))
+
+        rate_limiter = self.rate_limiters.get(operator_information['url'])
+        if rate_limiter is None:
+            rate_limiter = self.rate_limiters[operator_information['url']] = RateLimiter(self.rate_limit)
+
+        job = BackfillJob(
+            self.watcher, operator_information, start, end, sink,
+            state_path=os.path.join(self.directory, "{}.state.json".format(backfill_id)),
+            concurrency=concurrency,
+            rate_limiter=rate_limiter,
+        )
+        job.task = asyncio.ensure_future(job.run())
+        self.jobs[backfill_id] = job
+        return job
+
+    def cancel(self, backfill_id):
+        job = self.jobs.get(backfill_id)
+        if job is None:
+            return False
+        job.cancel()
+        return True
+
+    def stats(self):
+        return [job.progress() for job in self.jobs.values()]
+
+
+async def _report_progress(job, interval):
+    while True:
+        await asyncio.sleep(interval)
+        progress = job.progress()
+        job.logger.info("Backfill {id}: {done}/{total} ({percent}%), {entries_per_sec} entries/sec, eta {eta_seconds}s, {errors} errors".format(**progress))
+
+
+async def _run_cli(args, loop):
+    from certstream.watcher import TransparencyWatcher
+
+    watcher = TransparencyWatcher(loop)
+    watcher.pipeline.start()
+
+    sink = NdjsonSink(args.output)
+    job = BackfillJob(
+        watcher, {"url": args.log.rstrip('/'), "description": args.log}, args.start, args.end, sink,
+        state_path=args.state or args.output + '.state.json',
+        concurrency=args.concurrency,
+        chunk_size=args.chunk_size,
+        rate_limiter=RateLimiter(args.rate_limit) if args.rate_limit is not None else None,
+    )
+
+    # Stopping saves the state, so a rerun doesn't fetch anything twice
+    job.task = asyncio.ensure_future(job.run())
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, job.cancel)
+
+    reporter = asyncio.ensure_future(_report_progress(job, args.progress_interval))
+    try:
+        await job.task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        reporter.cancel()
+        watcher.pipeline.stop()
+        if watcher.session is not None:
+            await watcher.session.close()
+
+    return job
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='[%(levelname)s:%(name)s] %(asctime)s - %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Fetch a range of a CT log to an NDJSON file, in parallel and resumably")
+    parser.add_argument('log', help="log url, as it appears in the log list (e.g. ct.googleapis.com/logs/argon2024)")
+    parser.add_argument('start', type=int, help="first entry index to fetch")
+    parser.add_argument('end', type=int, help="entry index to stop before")
+    parser.add_argument('--output', required=True, help="NDJSON file the certificates are appended to")
+    parser.add_argument('--state', help="resumable state file (defaults to <output>.state.json)")
+    parser.add_argument('--concurrency', type=int, help="parallel fetchers (BACKFILL_CONCURRENCY, default 8)")
+    parser.add_argument('--chunk-size', type=int, help="entries per unit of work (BACKFILL_CHUNK_SIZE, default 8192)")
+    parser.add_argument('--rate-limit', type=float, help="most get-entries requests a second (BACKFILL_RATE_LIMIT, default 20, 0 for none)")
+    parser.add_argument('--progress-interval', type=float, default=10, help="seconds between progress reports")
+    args = parser.parse_args()
+
+    if args.start < 0 or args.end <= args.start:
+        parser.error("need 0 <= start < end")
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    job = loop.run_until_complete(_run_cli(args, loop))
+    print(json.dumps(job.progress(), indent=4))
+    raise SystemExit(0 if job.status == 'complete' else 1)
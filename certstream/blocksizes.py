@@ -0,0 +1,40 @@
+import collections
+import os
+
+
+class BlockSizes(object):
+    """
+    The page size to ask each log for. Logs cap get-entries at a size of their choosing and just hand back
+    fewer entries than asked for, so a short page tells us the cap - but only when the request went below
+    the tree head, since a page at the tail can come back short because the server answering it hasn't
+    caught up with the tree head yet. Every PROBE_INTERVAL requests to a capped log asks for a full
+    max_size page again, so a one-off short page (or a log raising its cap) doesn't keep us small forever.
+    """
+    PROBE_INTERVAL = int(os.getenv("FETCH_BLOCK_SIZE_PROBE_INTERVAL", 16))
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.sizes = {}
+        self.requests = collections.Counter()
+
+    def get(self, log_url):
+        size = self.sizes.get(log_url)
+        if size is None:
+            return self.max_size
+
+        self.requests[log_url] += 1
+        if self.requests[log_url] % self.PROBE_INTERVAL == 0:
+            return self.max_size
+
+        return size
+
+    def record(self, log_url, requested, returned, tail):
+        if returned >= requested:
+            # A full page bigger than what we'd learned means the cap went up (or never really existed)
+            if returned > self.sizes.get(log_url, self.max_size):
+                self.sizes[log_url] = returned
+            if returned >= self.max_size:
+                self.sizes.pop(log_url, None)
+                self.requests.pop(log_url, None)
+        elif not tail:
+            self.sizes[log_url] = returned
@@ -1,6 +1,8 @@
 import base64
 import datetime
+import hashlib
 import logging
+import os
 import time
 
 from collections import OrderedDict
@@ -9,6 +11,8 @@ from OpenSSL import crypto
 from construct import Struct, Byte, Int16ub, Int64ub, Enum, Bytes, \
     Int24ub, this, GreedyBytes, GreedyRange, Terminated, Embedded
 
+from certstream.tracing import lap
+
 
 MerkleTreeHeader = Struct(
     "Version"         / Byte,
@@ -78,6 +82,53 @@ def serialize_certificate(certificate):
         ).decode('utf-8')
     }
 
+class ChainCertificateCache(object):
+    """
+    Bounded LRU of already serialized chain certificates, keyed on a hash of their DER. Chains are nearly
+    always one of a handful of intermediates, so this skips loading and serializing them over and over.
+    The cached dicts are shared between entries and must not be mutated.
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size if max_size is not None else int(os.getenv("CHAIN_CACHE_SIZE", 1024))
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def serialize(self, cert_der, serializer=None):
+        key = hashlib.sha256(cert_der).digest()
+
+        serialized = self.entries.get(key)
+        if serialized is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return serialized
+
+        self.misses += 1
+        if serializer is None:
+            serialized = serialize_certificate(crypto.load_certificate(crypto.FILETYPE_ASN1, cert_der))
+        else:
+            serialized = serializer(cert_der)
+
+        if self.max_size > 0:
+            self.entries[key] = serialized
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+        return serialized
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+chain_cache = ChainCertificateCache()
+
 def add_all_domains(cert_data):
     all_domains = []
 
@@ -96,35 +147,37 @@ def add_all_domains(cert_data):
 
     return cert_data
 
-def parse_ctl_entry(entry, operator_information):
+def parse_ctl_entry(entry, operator_information, spans=None):
+    # spans is only passed for entries being traced, and gets how long each step took
+    started = time.perf_counter() if spans is not None else None
+
     mtl = MerkleTreeHeader.parse(base64.b64decode(entry['leaf_input']))
 
     cert_data = {}
 
     if mtl.LogEntryType == "X509LogEntryType":
         cert_data['update_type'] = "X509LogEntry"
-        chain = [crypto.load_certificate(crypto.FILETYPE_ASN1, Certificate.parse(mtl.Entry).CertData)]
+        leaf_der = Certificate.parse(mtl.Entry).CertData
         extra_data = CertificateChain.parse(base64.b64decode(entry['extra_data']))
-        for cert in extra_data.Chain:
-            chain.append(crypto.load_certificate(crypto.FILETYPE_ASN1, cert.CertData))
     else:
         cert_data['update_type'] = "PreCertEntry"
         extra_data = PreCertEntry.parse(base64.b64decode(entry['extra_data']))
-        chain = [crypto.load_certificate(crypto.FILETYPE_ASN1, extra_data.LeafCert.CertData)]
+        leaf_der = extra_data.LeafCert.CertData
 
-        for cert in extra_data.Chain:
-            chain.append(
-                crypto.load_certificate(crypto.FILETYPE_ASN1, cert.CertData)
-            )
+    started = lap(spans, 'decode', started)
+    leaf_cert = crypto.load_certificate(crypto.FILETYPE_ASN1, leaf_der)
+    started = lap(spans, 'x509_load', started)
 
     cert_data.update({
-        "leaf_cert": serialize_certificate(chain[0]),
-        "chain": [serialize_certificate(x) for x in chain[1:]],
+        "leaf_cert": serialize_certificate(leaf_cert),
+        "chain": [chain_cache.serialize(cert.CertData) for cert in extra_data.Chain],
         "cert_index": entry['index'],
         "seen": time.time()
     })
 
+    started = lap(spans, 'serialize_certificate', started)
     add_all_domains(cert_data)
+    lap(spans, 'add_all_domains', started)
 
     cert_data['source'] = {
         "url": operator_information['url'],
@@ -132,3 +185,10 @@ def parse_ctl_entry(entry, operator_information):
     }
 
     return cert_data
+
+def parse_ctl_entries(entries, operator_information, parse_entry=parse_ctl_entry):
+    # Batch entry point so a whole get-entries response can be shipped to a worker process in one go
+    return [
+        parse_entry(entry, operator_information, entry['trace']['spans'] if 'trace' in entry else None)
+        for entry in entries
+    ]
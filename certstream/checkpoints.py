@@ -0,0 +1,113 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+
+from certstream.util import atomic_write
+
+
+class CheckpointStore(object):
+    """
+    Remembers, per log url, the index of the next entry we need to emit so a restart can pick up where the
+    last process left off. Checkpoints are updated in memory on the hot path and written to disk in the
+    background every CHECKPOINT_FLUSH_INTERVAL seconds, always through a rename so a crash mid-write can't
+    leave a truncated file behind.
+
+    An entry only counts as emitted once it's actually been broadcast. The watcher tells us about every
+    certificate it hands on (hand_off) and whoever broadcasts it tells us when that's done (done), so a
+    checkpoint never moves past anything still waiting in the stream queue or held back by deduplication.
+    """
+    def __init__(self, path=None, flush_interval=None):
+        self.logger = logging.getLogger('certstream.checkpoints')
+
+        self.path = path if path is not None else os.getenv("CHECKPOINT_FILE")
+        self.flush_interval = flush_interval if flush_interval is not None else int(os.getenv("CHECKPOINT_FLUSH_INTERVAL", 5))
+
+        self.checkpoints = {}
+        self.dirty = False
+
+        # Per log, the next index the watcher will hand on, the indexes it has handed on that haven't been
+        # broadcast yet (oldest first) and any of those broadcast ahead of an older one
+        self.positions = {}
+        self.outstanding = collections.defaultdict(collections.deque)
+        self.done_early = collections.defaultdict(set)
+
+        if self.enabled:
+            self._load()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            self.logger.info("No checkpoint file at {}, starting fresh".format(self.path))
+            return
+
+        try:
+            with open(self.path) as f:
+                self.checkpoints = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.warning("Unable to read checkpoint file {}, ignoring it -> {}".format(self.path, e))
+            return
+
+        self.logger.info("Loaded checkpoints for {} logs from {}".format(len(self.checkpoints), self.path))
+
+    def get(self, log_url):
+        return self.checkpoints.get(log_url)
+
+    def set(self, log_url, next_index):
+        """
+        Everything before next_index has been handed on or skipped.
+        """
+        self.positions[log_url] = next_index
+        self._update(log_url)
+
+    def hand_off(self, log_url, cert_index):
+        if self.enabled:
+            self.outstanding[log_url].append(cert_index)
+
+    def done(self, log_url, cert_index):
+        if not self.enabled:
+            return
+
+        outstanding = self.outstanding[log_url]
+        if not outstanding:
+            return
+
+        if outstanding[0] != cert_index:
+            # Broadcast ahead of an older certificate still held back by DEDUP_MODE=merge
+            self.done_early[log_url].add(cert_index)
+            return
+
+        outstanding.popleft()
+        done_early = self.done_early[log_url]
+        while outstanding and outstanding[0] in done_early:
+            done_early.discard(outstanding.popleft())
+
+        self._update(log_url)
+
+    def _update(self, log_url):
+        outstanding = self.outstanding.get(log_url)
+        next_index = outstanding[0] if outstanding else self.positions.get(log_url)
+        if next_index is not None and self.checkpoints.get(log_url) != next_index:
+            self.checkpoints[log_url] = next_index
+            self.dirty = True
+
+    def flush(self):
+        if not self.enabled or not self.dirty:
+            return
+
+        self.dirty = False
+
+        try:
+            atomic_write(self.path, json.dumps(self.checkpoints, indent=4, sort_keys=True))
+        except OSError as e:
+            self.dirty = True
+            self.logger.warning("Unable to write checkpoint file {} -> {}".format(self.path, e))
+
+    async def flush_task(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
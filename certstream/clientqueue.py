@@ -0,0 +1,151 @@
+import asyncio
+import collections
+import json
+import os
+import time
+
+from certstream import metrics
+
+POLICIES = ('drop-oldest', 'drop-newest', 'disconnect')
+
+
+class ClientQueue(object):
+    """
+    Per-client outgoing frame queue that never blocks the producer. What happens once a client falls
+    behind is down to its policy:
+
+      drop-oldest - evict the oldest queued frames to make room
+      drop-newest - refuse new frames, then tell the client how many it missed with a `dropped` message
+      disconnect  - give up on the client (via on_overflow) once it's full or max_lag seconds behind
+
+    The queue is full when it holds max_size frames or max_bytes of them, whichever comes first.
+    """
+    # Server defaults, which are also the most a client can ask for (see limit())
+    MAX_SIZE = int(os.getenv("CLIENT_QUEUE_SIZE", 500))
+    MAX_BYTES = int(os.getenv("CLIENT_QUEUE_BYTES", 16 * 1024 * 1024))
+    MAX_LAG = float(os.getenv("CLIENT_MAX_LAG", 60))
+
+    def __init__(self, policy=None, max_size=None, max_bytes=None, max_lag=None, on_overflow=None):
+        self.policy = policy if policy is not None else os.getenv("CLIENT_QUEUE_POLICY", "drop-newest")
+        self.max_size = max_size if max_size is not None else self.MAX_SIZE
+        self.max_bytes = max_bytes if max_bytes is not None else self.MAX_BYTES
+        self.max_lag = max_lag if max_lag is not None else self.MAX_LAG
+        self.on_overflow = on_overflow
+
+        if self.policy not in POLICIES:
+            raise ValueError("Unknown queue policy {}, expected one of {}".format(self.policy, ", ".join(POLICIES)))
+
+        self.items = collections.deque()
+        self.size_bytes = 0
+        self.getter = None
+
+        self.dropped = 0
+        self.pending_gap = 0
+        self.overflowed = False
+
+    @staticmethod
+    def limit(name, value, server_max):
+        """
+        A queue limit asked for by a client, which can tighten the server's but never loosen it. A server
+        max of 0 means the server doesn't limit it either.
+        """
+        if not value > 0:
+            raise ValueError("{} must be greater than 0".format(name))
+        return min(value, server_max) if server_max > 0 else value
+
+    def qsize(self):
+        return len(self.items)
+
+    def lag(self):
+        # How long the oldest frame has been waiting, in seconds
+        return time.monotonic() - self.items[0][1] if self.items else 0.0
+
+    def _full(self, frame_size):
+        if not self.items:
+            return False
+        return len(self.items) >= self.max_size or (self.max_bytes > 0 and self.size_bytes + frame_size > self.max_bytes)
+
+    def _append(self, frame, timestamp):
+        self.items.append((frame, timestamp))
+        self.size_bytes += len(frame)
+
+    def put_nowait(self, frame):
+        if self.overflowed:
+            return False
+
+        now = time.monotonic()
+
+        if self.policy == 'disconnect':
+            if self._full(len(frame)) or (self.items and now - self.items[0][1] > self.max_lag):
+                self.overflowed = True
+                metrics.CLIENT_DISCONNECTS.inc()
+                if self.on_overflow is not None:
+                    self.on_overflow()
+                return False
+
+        elif self.policy == 'drop-newest':
+            if self._full(len(frame)):
+                self.dropped += 1
+                self.pending_gap += 1
+                metrics.CLIENT_DROPPED.inc()
+                return False
+
+            if self.pending_gap:
+                self._append(json.dumps({"message_type": "dropped", "count": self.pending_gap}), now)
+                self.pending_gap = 0
+
+        else:
+            while self._full(len(frame)):
+                old_frame, _ = self.items.popleft()
+                self.size_bytes -= len(old_frame)
+                self.dropped += 1
+                metrics.CLIENT_DROPPED.inc()
+
+        self._append(frame, now)
+
+        if self.getter is not None and not self.getter.done():
+            self.getter.set_result(None)
+
+        return True
+
+    def _pop(self):
+        frame, timestamp = self.items.popleft()
+        self.size_bytes -= len(frame)
+        metrics.CLIENT_QUEUE_WAIT.observe(time.monotonic() - timestamp)
+        return frame
+
+    async def get(self):
+        while not self.items:
+            self.getter = asyncio.get_event_loop().create_future()
+            try:
+                await self.getter
+            finally:
+                self.getter = None
+
+        return self._pop()
+
+    async def get_batch(self, max_items, max_delay):
+        """
+        Wait for at least one frame, then keep collecting until there are max_items of them or max_delay
+        seconds have passed since the first one arrived.
+        """
+        frames = [await self.get()]
+        deadline = time.monotonic() + max_delay
+
+        while len(frames) < max_items:
+            if not self.items:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                self.getter = asyncio.get_event_loop().create_future()
+                try:
+                    await asyncio.wait_for(self.getter, remaining)
+                except asyncio.TimeoutError:
+                    break
+                finally:
+                    self.getter = None
+
+            frames.append(self._pop())
+
+        return frames
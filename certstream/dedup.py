@@ -0,0 +1,152 @@
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import time
+
+from certstream import metrics
+
+DEDUP_MODES = ('off', 'first', 'merge')
+
+
+def dedup_key(cert_data):
+    """
+    What a certificate is deduplicated on: its issuer and serial number, which a precertificate shares
+    with the certificate later issued from it. The issuer is taken from the leaf's authority key
+    identifier where it has one and from the subject of the first chain certificate otherwise. Hashed down
+    to a 64 bit int to keep the seen sets small.
+    """
+    leaf_cert = cert_data['leaf_cert']
+    issuer = leaf_cert['extensions'].get('authorityKeyIdentifier')
+    if not issuer and cert_data['chain']:
+        issuer = cert_data['chain'][0]['subject']['aggregated']
+    digest = hashlib.blake2b('{}/{}'.format(issuer, leaf_cert['serial_number']).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class RotatingKeySet(object):
+    """
+    Keys seen in roughly the last `window` seconds, as two generations of plain sets. Lookups check both,
+    and once the current generation is a window old (or holds max_keys / 2 keys) the older one is dropped
+    and a fresh one started, so keys are remembered for between one and two windows in bounded memory.
+    """
+    def __init__(self, window, max_keys):
+        self.window = window
+        self.max_keys = max_keys
+        self.current = set()
+        self.previous = set()
+        self.rotated = time.monotonic()
+        self.rotations = 0
+
+    def __contains__(self, key):
+        return key in self.current or key in self.previous
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+    def add(self, key):
+        if time.monotonic() - self.rotated >= self.window or len(self.current) >= self.max_keys // 2:
+            self.previous = self.current
+            self.current = set()
+            self.rotated = time.monotonic()
+            self.rotations += 1
+        self.current.add(key)
+
+
+class Deduplicator(object):
+    """
+    Optional stage between the parsers and the stream that keeps the same issuance, seen as a
+    precertificate and a certificate in several logs, from being broadcast once per copy. With
+    DEDUP_MODE=first only the first sighting goes out. With DEDUP_MODE=merge the first sighting is held
+    for DEDUP_MERGE_DELAY seconds while further sightings are collected, then goes out once with every one
+    of them listed under "sources". Sightings after that are dropped either way.
+    """
+    def __init__(self, mode=None, window=None, max_keys=None, merge_delay=None):
+        self.mode = mode if mode is not None else os.getenv("DEDUP_MODE", "off")
+        if self.mode not in DEDUP_MODES:
+            raise ValueError("Unknown DEDUP_MODE {}, expected one of {}".format(self.mode, ", ".join(DEDUP_MODES)))
+
+        window = window if window is not None else float(os.getenv("DEDUP_WINDOW", 3600))
+        max_keys = max_keys if max_keys is not None else int(os.getenv("DEDUP_MAX_KEYS", 2000000))
+        self.merge_delay = merge_delay if merge_delay is not None else float(os.getenv("DEDUP_MERGE_DELAY", 10))
+
+        self.seen = RotatingKeySet(window, max_keys)
+
+        # Records waiting out their merge delay, oldest first: key -> (deadline, record, sightings)
+        self.pending = collections.OrderedDict()
+        self.pending_added = asyncio.Event()
+        self.duplicates = 0
+
+        metrics.DEDUP_KEYS.set_function(lambda: len(self.seen))
+        metrics.DEDUP_PENDING.set_function(lambda: len(self.pending))
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def filter(self, record):
+        """
+        The record to put on the stream now, or None if it's a duplicate or is being held for merging.
+        """
+        key = record.dedup_key
+
+        held = self.pending.get(key)
+        if held is not None:
+            held[2].append(record.sighting)
+            self._count_duplicate()
+            return None
+
+        if key in self.seen:
+            self._count_duplicate()
+            return None
+
+        self.seen.add(key)
+
+        if self.mode == 'first':
+            return record
+
+        self.pending[key] = (time.monotonic() + self.merge_delay, record, [record.sighting])
+        self.pending_added.set()
+        return None
+
+    def holding(self, record):
+        """
+        Whether filter() kept hold of record for merging, rather than dropping it as a duplicate.
+        """
+        held = self.pending.get(record.dedup_key)
+        return held is not None and held[1] is record
+
+    def _count_duplicate(self):
+        self.duplicates += 1
+        metrics.DEDUP_DUPLICATES.inc()
+
+    def _merged(self, record, sightings):
+        # Spliced onto the already encoded data rather than decoding and encoding it again
+        record.data_json = '{}, "sources": {}}}'.format(record.data_json[:-1], json.dumps(sightings))
+        return record
+
+    async def merge_task(self, stream):
+        while self.mode == 'merge':
+            if not self.pending:
+                self.pending_added.clear()
+                await self.pending_added.wait()
+                continue
+
+            key, (deadline, record, sightings) = next(iter(self.pending.items()))
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            del self.pending[key]
+            await stream.put(self._merged(record, sightings))
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "keys": len(self.seen),
+            "rotations": self.seen.rotations,
+            "pending": len(self.pending),
+            "duplicates": self.duplicates,
+        }
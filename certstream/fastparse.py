@@ -0,0 +1,355 @@
+"""
+Fast path parser backend, selected with PARSER_BACKEND=fast.
+
+The TLS framing of MerkleTreeLeaf entries is decoded with plain struct/memoryview slicing instead of the
+construct Structs in certlib, and the subject, validity, serial, fingerprint and DER of each certificate
+are read straight out of the DER instead of being walked field by field through pyOpenSSL. Extensions are
+still rendered by OpenSSL, as their text form is what certlib has always emitted and there's no way to be
+byte-for-byte compatible with it otherwise.
+
+Anything this module doesn't fully understand (unusual string types, unknown name attributes, non
+canonical encodings...) falls back to certlib.serialize_certificate for that certificate, so the output
+is always identical to the construct backend. compare_backends() checks that, run it over synthetic
+entries covering both paths, or a saved get-entries response, with:
+
+    python -m benchmarks.differential [--fixtures entries.json]
+"""
+import base64
+import datetime
+import hashlib
+import json
+import struct
+import time
+
+from OpenSSL import crypto
+
+from certstream.certlib import add_all_domains, chain_cache, dump_extensions
+from certstream.certlib import parse_ctl_entry as reference_parse_ctl_entry
+from certstream.certlib import serialize_certificate as reference_serialize_certificate
+from certstream.tracing import lap
+
+
+class UnsupportedCertificate(Exception):
+    pass
+
+
+def _encode_oid(dotted):
+    arcs = [int(arc) for arc in dotted.split('.')]
+    encoded = bytearray([arcs[0] * 40 + arcs[1]])
+    for arc in arcs[2:]:
+        chunk = [arc & 0x7f]
+        arc >>= 7
+        while arc:
+            chunk.append(0x80 | (arc & 0x7f))
+            arc >>= 7
+        encoded.extend(reversed(chunk))
+    return bytes(encoded)
+
+
+# Short names OpenSSL uses in X509_NAME_oneline, anything else sends us down the slow path
+NAME_ATTRIBUTES = {_encode_oid(oid): short_name for oid, short_name in (
+    ('2.5.4.3', 'CN'),
+    ('2.5.4.4', 'SN'),
+    ('2.5.4.5', 'serialNumber'),
+    ('2.5.4.6', 'C'),
+    ('2.5.4.7', 'L'),
+    ('2.5.4.8', 'ST'),
+    ('2.5.4.9', 'street'),
+    ('2.5.4.10', 'O'),
+    ('2.5.4.11', 'OU'),
+    ('2.5.4.12', 'title'),
+    ('2.5.4.15', 'businessCategory'),
+    ('2.5.4.17', 'postalCode'),
+    ('2.5.4.42', 'GN'),
+    ('1.2.840.113549.1.9.1', 'emailAddress'),
+    ('0.9.2342.19200300.100.1.25', 'DC'),
+    ('1.3.6.1.4.1.311.60.2.1.1', 'jurisdictionL'),
+    ('1.3.6.1.4.1.311.60.2.1.2', 'jurisdictionST'),
+    ('1.3.6.1.4.1.311.60.2.1.3', 'jurisdictionC'),
+)}
+
+SUBJECT_FIELDS = ('C', 'ST', 'L', 'O', 'OU', 'CN')
+
+# Single byte string types, which OpenSSL hands back as latin-1. UTF8String (0x0c) is handled separately.
+SINGLE_BYTE_STRINGS = frozenset((0x12, 0x13, 0x14, 0x16, 0x1a))
+
+UTC_TIME = 0x17
+GENERALIZED_TIME = 0x18
+
+# X509_NAME_oneline is given a 512 byte buffer by pyOpenSSL and silently truncates past it
+ONELINE_MAX = 511
+
+_ESCAPED_BYTES = {n: ('\\x%02X' % n) if (n < 0x20 or n > 0x7e) else chr(n) for n in range(256)}
+
+
+def _read_tlv(der, offset, end):
+    if offset + 2 > end:
+        raise UnsupportedCertificate("Truncated DER")
+
+    tag = der[offset]
+    if tag & 0x1f == 0x1f:
+        raise UnsupportedCertificate("High tag number")
+
+    length = der[offset + 1]
+    offset += 2
+
+    if length & 0x80:
+        length_bytes = length & 0x7f
+        if length_bytes == 0 or length_bytes > 4 or offset + length_bytes > end or der[offset] == 0:
+            raise UnsupportedCertificate("Unsupported length encoding")
+        length = int.from_bytes(der[offset:offset + length_bytes], 'big')
+        if length < 0x80:
+            raise UnsupportedCertificate("Non minimal length")
+        offset += length_bytes
+
+    if offset + length > end:
+        raise UnsupportedCertificate("Truncated DER")
+
+    return tag, offset, offset + length
+
+
+def _expect(der, offset, end, expected_tag):
+    tag, start, stop = _read_tlv(der, offset, end)
+    if tag != expected_tag:
+        raise UnsupportedCertificate("Expected tag {:#x}, got {:#x}".format(expected_tag, tag))
+    return start, stop
+
+
+def _parse_time(der, offset, end):
+    tag, start, stop = _read_tlv(der, offset, end)
+    value = bytes(der[start:stop])
+
+    if tag == UTC_TIME and len(value) == 13 and value[12:] == b'Z' and value[:12].isdigit():
+        year = int(value[0:2])
+        year += 1900 if year >= 50 else 2000
+        value = value[2:]
+    elif tag == GENERALIZED_TIME and len(value) == 15 and value[14:] == b'Z' and value[:14].isdigit():
+        year = int(value[0:4])
+        value = value[4:]
+    else:
+        raise UnsupportedCertificate("Unsupported time format")
+
+    try:
+        # Naive datetimes on purpose, certlib's strptime() results are interpreted in local time too
+        timestamp = datetime.datetime(
+            year, int(value[0:2]), int(value[2:4]), int(value[4:6]), int(value[6:8]), int(value[8:10])
+        ).timestamp()
+    except ValueError:
+        raise UnsupportedCertificate("Invalid time")
+
+    return timestamp, stop
+
+
+def _parse_name(der, start, end):
+    subject = dict.fromkeys(SUBJECT_FIELDS)
+    aggregated = []
+    aggregated_length = 0
+
+    offset = start
+    while offset < end:
+        rdn_start, rdn_end = _expect(der, offset, end, 0x31)
+        offset = rdn_end
+
+        attribute_offset = rdn_start
+        while attribute_offset < rdn_end:
+            attribute_start, attribute_end = _expect(der, attribute_offset, rdn_end, 0x30)
+            attribute_offset = attribute_end
+
+            oid_start, oid_end = _expect(der, attribute_start, attribute_end, 0x06)
+            short_name = NAME_ATTRIBUTES.get(bytes(der[oid_start:oid_end]))
+            if short_name is None:
+                raise UnsupportedCertificate("Unknown name attribute")
+
+            value_tag, value_start, value_end = _read_tlv(der, oid_end, attribute_end)
+            if value_end != attribute_end:
+                raise UnsupportedCertificate("Trailing data in name attribute")
+
+            raw_value = bytes(der[value_start:value_end])
+
+            if value_tag == 0x0c:
+                try:
+                    value = raw_value.decode('ascii')
+                except UnicodeDecodeError:
+                    raise UnsupportedCertificate("Non ASCII UTF8String")
+            elif value_tag in SINGLE_BYTE_STRINGS:
+                value = raw_value.decode('latin-1')
+            else:
+                raise UnsupportedCertificate("Unsupported string type")
+
+            # Same rendering as X509_NAME_oneline, raw bytes with anything outside printable ASCII escaped
+            entry = '/{}={}'.format(short_name, ''.join([_ESCAPED_BYTES[n] for n in raw_value]))
+            aggregated_length += len(entry)
+            if aggregated_length > ONELINE_MAX:
+                raise UnsupportedCertificate("Name too long")
+            aggregated.append(entry)
+
+            # pyOpenSSL returns the first matching attribute
+            if short_name in subject and subject[short_name] is None:
+                subject[short_name] = value
+
+    serialized = {"aggregated": ''.join(aggregated)}
+    serialized.update(subject)
+    return serialized
+
+
+def parse_certificate_fields(cert_der):
+    """
+    Pull the fields serialize_certificate needs (minus extensions) straight out of the DER.
+    Raises UnsupportedCertificate for anything we can't guarantee is handled the same way OpenSSL would.
+    """
+    der = memoryview(cert_der)
+    length = len(der)
+
+    certificate_start, certificate_end = _expect(der, 0, length, 0x30)
+    if certificate_end != length:
+        raise UnsupportedCertificate("Trailing data after certificate")
+
+    tbs_start, tbs_end = _expect(der, certificate_start, certificate_end, 0x30)
+
+    tag, start, offset = _read_tlv(der, tbs_start, tbs_end)
+    if tag == 0xa0:
+        tag, start, offset = _read_tlv(der, offset, tbs_end)
+
+    if tag != 0x02 or start == offset:
+        raise UnsupportedCertificate("Bad serial number")
+    serial_number = int.from_bytes(der[start:offset], 'big', signed=True)
+
+    _, offset = _expect(der, offset, tbs_end, 0x30)  # signature algorithm
+    _, offset = _expect(der, offset, tbs_end, 0x30)  # issuer
+
+    validity_start, offset = _expect(der, offset, tbs_end, 0x30)
+    not_before, time_offset = _parse_time(der, validity_start, offset)
+    not_after, time_offset = _parse_time(der, time_offset, offset)
+    if time_offset != offset:
+        raise UnsupportedCertificate("Trailing data in validity")
+
+    subject_start, offset = _expect(der, offset, tbs_end, 0x30)
+    subject = _parse_name(der, subject_start, offset)
+
+    return {
+        "subject": subject,
+        "not_before": not_before,
+        "not_after": not_after,
+        "serial_number": serial_number,
+    }
+
+
+def serialize_certificate(cert_der):
+    cert_der = bytes(cert_der)
+
+    try:
+        fields = parse_certificate_fields(cert_der)
+    except UnsupportedCertificate:
+        return reference_serialize_certificate(crypto.load_certificate(crypto.FILETYPE_ASN1, cert_der))
+
+    fingerprint = hashlib.sha1(cert_der).hexdigest().upper()
+
+    return {
+        "subject": fields['subject'],
+        "extensions": dump_extensions(crypto.load_certificate(crypto.FILETYPE_ASN1, cert_der)),
+        "not_before": fields['not_before'],
+        "not_after": fields['not_after'],
+        "serial_number": '{0:x}'.format(fields['serial_number']),
+        "fingerprint": ':'.join([fingerprint[i:i + 2] for i in range(0, len(fingerprint), 2)]),
+        "as_der": base64.b64encode(cert_der).decode('utf-8')
+    }
+
+
+def _read_u24(buf, offset):
+    if offset + 3 > len(buf):
+        raise ValueError("Truncated length prefix at {}".format(offset))
+    return (buf[offset] << 16) | (buf[offset + 1] << 8) | buf[offset + 2]
+
+
+def _read_certificate(buf, offset):
+    length = _read_u24(buf, offset)
+    end = offset + 3 + length
+    if end > len(buf):
+        raise ValueError("Truncated certificate at {}".format(offset))
+    return buf[offset + 3:end], end
+
+
+def _read_chain(buf, offset):
+    # Mirrors CertificateChain: the declared chain length is skipped and certificates are read greedily
+    # until one doesn't fit
+    _read_u24(buf, offset)
+    offset += 3
+
+    chain = []
+    while offset + 3 <= len(buf):
+        length = _read_u24(buf, offset)
+        if offset + 3 + length > len(buf):
+            break
+        chain.append(buf[offset + 3:offset + 3 + length])
+        offset += 3 + length
+
+    return chain, offset
+
+
+def parse_ctl_entry(entry, operator_information, spans=None):
+    started = time.perf_counter() if spans is not None else None
+
+    leaf_input = memoryview(base64.b64decode(entry['leaf_input']))
+    extra_data = memoryview(base64.b64decode(entry['extra_data']))
+
+    if len(leaf_input) < 12:
+        raise ValueError("Truncated MerkleTreeLeaf")
+
+    log_entry_type, = struct.unpack_from('>H', leaf_input, 10)
+
+    cert_data = {}
+
+    if log_entry_type == 0:
+        cert_data['update_type'] = "X509LogEntry"
+        leaf_cert, _ = _read_certificate(leaf_input, 12)
+        chain, _ = _read_chain(extra_data, 0)
+    else:
+        cert_data['update_type'] = "PreCertEntry"
+        leaf_cert, offset = _read_certificate(extra_data, 0)
+        chain, offset = _read_chain(extra_data, offset)
+        if offset != len(extra_data):
+            raise ValueError("Trailing data after precertificate chain")
+
+    # Certificates are read straight from DER, there's no separate x509_load step
+    started = lap(spans, 'decode', started)
+
+    cert_data.update({
+        "leaf_cert": serialize_certificate(leaf_cert),
+        "chain": [chain_cache.serialize(bytes(cert), serialize_certificate) for cert in chain],
+        "cert_index": entry['index'],
+        "seen": time.time()
+    })
+
+    started = lap(spans, 'serialize_certificate', started)
+    add_all_domains(cert_data)
+    lap(spans, 'add_all_domains', started)
+
+    cert_data['source'] = {
+        "url": operator_information['url'],
+        "name": operator_information['description']
+    }
+
+    return cert_data
+
+
+def compare_backends(entries, operator_information):
+    """
+    Differential check of this backend against certlib.parse_ctl_entry. Returns a list of
+    (index, reference_json, fast_json) for every entry where the two disagree.
+
+    The chain cache is emptied before each parse, otherwise the second backend would just get the
+    first one's chain certificates back out of it and they'd never be compared.
+    """
+    mismatches = []
+    for entry in entries:
+        chain_cache.clear()
+        reference = reference_parse_ctl_entry(entry, operator_information)
+        chain_cache.clear()
+        fast = parse_ctl_entry(entry, operator_information)
+        fast['seen'] = reference['seen']
+
+        reference_json, fast_json = json.dumps(reference), json.dumps(fast)
+        if reference_json != fast_json:
+            mismatches.append((entry.get('index'), reference_json, fast_json))
+    return mismatches
+
@@ -0,0 +1,171 @@
+import collections
+import fnmatch
+import re
+
+PATTERN_TYPES = ('exact', 'suffix', 'subdomain', 'substring', 'wildcard')
+
+
+def parse_pattern(raw_pattern):
+    """
+    Turn a client supplied pattern into a (type, value) tuple. An explicit "type:" prefix always wins,
+    otherwise "*.example.com" means any subdomain of example.com, anything else containing a "*" is a
+    shell style wildcard and a bare name is an exact match.
+    """
+    pattern = raw_pattern.strip().lower()
+
+    pattern_type, _, value = pattern.partition(':')
+    if value and pattern_type in PATTERN_TYPES:
+        pattern = value
+    elif pattern.startswith('*.') and '*' not in pattern[2:]:
+        pattern_type, pattern = 'subdomain', pattern[2:]
+    elif '*' in pattern:
+        pattern_type = 'wildcard'
+    else:
+        pattern_type = 'exact'
+
+    if pattern_type in ('exact', 'suffix', 'subdomain'):
+        pattern = pattern.strip('.')
+
+    if not pattern:
+        raise ValueError("Empty pattern in {!r}".format(raw_pattern))
+
+    return pattern_type, pattern
+
+
+class _SuffixTrie(object):
+    # Nodes are keyed on domain labels from right to left, so "www.example.com" walks com -> example -> www.
+    # Each node keeps who wants the exact name, who wants the name or anything under it and who only
+    # wants things strictly under it.
+    Node = collections.namedtuple('Node', ['children', 'exact', 'suffix', 'subdomain'])
+
+    def __init__(self):
+        self.root = self._new_node()
+
+    def _new_node(self):
+        return self.Node({}, set(), set(), set())
+
+    def add(self, pattern_type, domain, subscriber):
+        node = self.root
+        for label in reversed(domain.split('.')):
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = self._new_node()
+            node = child
+        getattr(node, pattern_type).add(subscriber)
+
+    def search(self, domain, matched):
+        labels = domain.split('.')
+        node = self.root
+        for depth, label in enumerate(reversed(labels), 1):
+            node = node.children.get(label)
+            if node is None:
+                return
+            if node.suffix:
+                matched.update(node.suffix)
+            if depth < len(labels):
+                if node.subdomain:
+                    matched.update(node.subdomain)
+            elif node.exact:
+                matched.update(node.exact)
+
+
+class _SubstringAutomaton(object):
+    # Plain Aho-Corasick, a single pass over a domain finds every registered substring in it
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+
+        for pattern, subscribers in patterns.items():
+            node = 0
+            for char in pattern:
+                next_node = self.goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(set())
+                    self.goto[node][char] = next_node
+                node = next_node
+            self.output[node].update(subscribers)
+
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self.goto[node].items():
+                queue.append(next_node)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_node] = self.goto[fallback].get(char, 0) if node else 0
+                self.output[next_node] |= self.output[self.fail[next_node]]
+
+    def search(self, text, matched):
+        goto, fail, output = self.goto, self.fail, self.output
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                matched.update(output[node])
+
+
+class SubscriptionIndex(object):
+    """
+    Shared index over every client's domain patterns. A certificate is matched once against all of the
+    subscriptions and we get back the set of subscribers interested in it, rather than every client
+    looping over its own patterns. The compiled structures are rebuilt lazily whenever someone
+    subscribes or leaves, which is rare compared to the rate certificates come in.
+    """
+    def __init__(self):
+        self.subscriptions = {}
+        self._compiled = None
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def add(self, subscriber, patterns):
+        self.subscriptions[subscriber] = [parse_pattern(pattern) for pattern in patterns]
+        self._compiled = None
+
+    def remove(self, subscriber):
+        if self.subscriptions.pop(subscriber, None) is not None:
+            self._compiled = None
+
+    def _compile(self):
+        trie = _SuffixTrie()
+        substrings = collections.defaultdict(set)
+        wildcards = collections.defaultdict(set)
+
+        for subscriber, patterns in self.subscriptions.items():
+            for pattern_type, pattern in patterns:
+                if pattern_type == 'substring':
+                    substrings[pattern].add(subscriber)
+                elif pattern_type == 'wildcard':
+                    wildcards[pattern].add(subscriber)
+                else:
+                    trie.add(pattern_type, pattern, subscriber)
+
+        automaton = _SubstringAutomaton(substrings) if substrings else None
+        wildcards = [(re.compile(fnmatch.translate(pattern)).match, subscribers) for pattern, subscribers in wildcards.items()]
+
+        self._compiled = (trie, automaton, wildcards)
+
+    def match(self, domains):
+        if self._compiled is None:
+            self._compile()
+
+        trie, automaton, wildcards = self._compiled
+
+        matched = set()
+        for domain in domains:
+            domain = domain.lower()
+            trie.search(domain, matched)
+            if automaton is not None:
+                automaton.search(domain, matched)
+            for pattern_match, subscribers in wildcards:
+                if pattern_match(domain):
+                    matched.update(subscribers)
+
+        return matched
@@ -0,0 +1,75 @@
+import gzip
+import hashlib
+import os
+import time
+
+from aiohttp import web
+
+
+class CachedJsonResponse(object):
+    """
+    Body of a JSON endpoint that gets polled far more often than it changes. build returns the body as
+    already encoded JSON text, spliced together from frames that were encoded for the websockets anyway.
+    It's rebuilt on the first request after invalidate(), but no more than once every HTTP_CACHE_MIN_AGE
+    seconds however fast certificates come in, and only gzipped once a client that accepts gzip asks for
+    it. Every body carries an ETag so pollers that already have it get a bodiless 304. The gzipped and
+    plain bodies are different bytes, so each gets its own ETag.
+    """
+    def __init__(self, build, compress=None, min_age=None):
+        self.build = build
+        self.compress = compress if compress is not None else os.getenv("HTTP_GZIP", "true").lower() not in ("0", "false", "no")
+        self.min_age = min_age if min_age is not None else float(os.getenv("HTTP_CACHE_MIN_AGE", 0.25))
+
+        self.body = None
+        self.gzipped_body = None
+        self.digest = None
+        self.stale = True
+        self.built = 0
+
+    def invalidate(self):
+        # Called for every certificate, so all it does is mark the body as out of date
+        self.stale = True
+
+    def _refresh(self):
+        self.body = self.build().encode('utf-8')
+        self.digest = hashlib.sha1(self.body).hexdigest()
+        self.gzipped_body = None
+        self.stale = False
+        self.built = time.monotonic()
+
+    def _gzipped(self):
+        if self.gzipped_body is None:
+            self.gzipped_body = gzip.compress(self.body, compresslevel=6)
+        return self.gzipped_body
+
+    def _not_modified(self, request, etag):
+        if_none_match = request.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        return etag in (tag.strip().replace('W/', '', 1) for tag in if_none_match.split(','))
+
+    def response(self, request):
+        if self.body is None or (self.stale and time.monotonic() - self.built >= self.min_age):
+            self._refresh()
+
+        headers = {
+            "Access-Control-Allow-Origin": "*",
+            "Vary": "Accept-Encoding",
+        }
+
+        body, etag = self.body, '"{}"'.format(self.digest)
+        if self.compress and 'gzip' in request.headers.get('Accept-Encoding', ''):
+            gzipped_body = self._gzipped()
+            if len(gzipped_body) < len(body):
+                body, etag = gzipped_body, '"{}-gzip"'.format(self.digest)
+                headers["Content-Encoding"] = "gzip"
+        headers["ETag"] = etag
+
+        if self._not_modified(request, etag):
+            # Content-Encoding only describes a body, which a 304 doesn't have
+            headers.pop("Content-Encoding", None)
+            return web.Response(status=304, headers=headers)
+
+        return web.Response(body=body, headers=headers, content_type="application/json")
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+
+import aiohttp
+
+from certstream.util import atomic_write
+
+
+class LogList(object):
+    """
+    The CT logs we should be watching. A local copy is read at startup so we never have to wait on, or die
+    without, the network, and the list is refreshed from url in the background with every good download
+    saved over the local copy for next time. Leave url empty to only ever use the local file.
+
+    Both the v1 log list format (a top level "logs" list) and the v3 one (logs grouped under "operators",
+    each with a "state") are understood, and either comes out as v1 style entries keyed by url.
+    """
+    DEFAULT_URL = 'https://www.gstatic.com/ct/log_list/all_logs_list.json'
+
+    # v3 log states we don't bother polling, they'll never hand out anything new
+    DEAD_STATES = ('retired', 'rejected')
+
+    def __init__(self, url=None, path=None, refresh_interval=None):
+        self.logger = logging.getLogger('certstream.loglist')
+
+        self.url = url if url is not None else os.getenv("CT_LOG_LIST_URL", self.DEFAULT_URL)
+        self.path = path if path is not None else os.getenv("CT_LOG_LIST_FILE", "ct_log_list.json")
+        self.refresh_interval = refresh_interval if refresh_interval is not None else float(os.getenv("CT_LOG_LIST_REFRESH_INTERVAL", 3600))
+
+    def load(self):
+        """
+        The logs in the local copy, or None if there isn't a usable one.
+        """
+        if not self.path or not os.path.exists(self.path):
+            self.logger.info("No local log list at {}".format(self.path))
+            return None
+
+        try:
+            with open(self.path) as f:
+                logs = self.parse(json.load(f))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.warning("Unable to read local log list {}, ignoring it -> {}".format(self.path, e))
+            return None
+
+        self.logger.info("Loaded {} logs from {}".format(len(logs), self.path))
+        return logs
+
+    async def fetch(self, session):
+        """
+        Download the current list, save it locally and return its logs. Anything short of a usable list
+        raises, leaving the local copy alone.
+        """
+        async with session.get(self.url) as response:
+            response.raise_for_status()
+            body = await response.read()
+
+        try:
+            document = json.loads(body.decode('utf-8'))
+            logs = self.parse(document)
+        except (ValueError, KeyError, TypeError) as e:
+            raise aiohttp.ClientError("Invalid log list from {} -> {}".format(self.url, e))
+
+        if not logs:
+            raise aiohttp.ClientError("Log list from {} has no logs in it".format(self.url))
+
+        self._save(body)
+        return logs
+
+    def _save(self, body):
+        if not self.path:
+            return
+
+        try:
+            atomic_write(self.path, body)
+        except OSError as e:
+            self.logger.warning("Unable to write local log list {} -> {}".format(self.path, e))
+
+    @classmethod
+    def parse(cls, document):
+        if 'logs' in document:
+            logs = [dict(log) for log in document['logs']]
+        else:
+            logs = []
+            for operator in document['operators']:
+                for log in operator.get('logs', []):
+                    if any(state in log.get('state', {}) for state in cls.DEAD_STATES):
+                        continue
+                    logs.append({
+                        "description": log['description'],
+                        "url": log['url'],
+                        "maximum_merge_delay": log.get('mmd'),
+                        "operated_by": operator.get('name'),
+                    })
+
+        for log in logs:
+            # v3 lists carry the scheme, v1 ones don't, and urls are how we key checkpoints and metrics
+            if log['url'].startswith('https://'):
+                log['url'] = log['url'][len('https://'):]
+            if log['url'].endswith('/'):
+                log['url'] = log['url'][:-1]
+            log.setdefault('description', log['url'])
+
+        return logs
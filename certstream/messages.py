@@ -0,0 +1,176 @@
+import asyncio
+import json
+import os
+import time
+
+from certstream import metrics
+from certstream.dedup import dedup_key
+
+STREAM_TYPES = ('full', 'lite', 'domains-only')
+
+
+def _full_packet(data_packet):
+    return data_packet
+
+
+def _lite_packet(data_packet):
+    # Everything but the chain and the DER blobs, which is what most consumers actually read
+    cert_data = dict(data_packet['data'])
+    cert_data.pop('chain', None)
+
+    leaf_cert = dict(cert_data['leaf_cert'])
+    leaf_cert.pop('as_der', None)
+    cert_data['leaf_cert'] = leaf_cert
+
+    return {
+        "message_type": data_packet['message_type'],
+        "seq": data_packet['seq'],
+        "data": cert_data
+    }
+
+
+def _domains_only_packet(data_packet):
+    return {
+        "message_type": "dns_entries",
+        "seq": data_packet['seq'],
+        "data": data_packet['data']['leaf_cert']['all_domains']
+    }
+
+
+PACKET_BUILDERS = {
+    'full': _full_packet,
+    'lite': _lite_packet,
+    'domains-only': _domains_only_packet,
+}
+
+ENCODE_SECONDS = {stream_type: metrics.ENCODE_SECONDS.labels(stream_type) for stream_type in STREAM_TYPES}
+
+
+class EncodedCertificate(object):
+    """
+    What the watcher hands on for a parsed entry: its data encoded to JSON once, right where it was parsed,
+    along with the few fields needed on the way out so nothing has to decode it again. One string is a
+    fraction of the size of the nested dicts the parsers produce, and far cheaper to send back from a
+    parsing worker.
+    """
+    __slots__ = ('data_json', 'all_domains', 'log_url', 'cert_index', 'seen', 'dedup_key', 'sighting', 'trace')
+
+    def __init__(self, cert_data):
+        self.data_json = json.dumps(cert_data)
+        self.all_domains = cert_data['leaf_cert']['all_domains']
+        self.log_url = cert_data['source']['url']
+        self.cert_index = cert_data['cert_index']
+        self.seen = cert_data.get('seen')
+
+        # Only used by the dedup stage, to recognise the same issuance from another log and say where
+        # it was seen
+        self.dedup_key = dedup_key(cert_data)
+        self.sighting = dict(cert_data['source'], update_type=cert_data['update_type'], cert_index=self.cert_index)
+
+        # Set by the pipeline on the odd entry that's being traced
+        self.trace = None
+
+    @property
+    def size(self):
+        return len(self.data_json)
+
+
+class CertificateMessage(object):
+    """
+    A certificate_update along with its encoded frames. Each stream type is encoded at most once, the
+    first time a subscriber of that type needs it, and the same string is then shared by every client.
+
+    Messages built from already encoded data (from the watcher or relayed from an ingest node) get their
+    full frame spliced together around it, and the data is only decoded if something actually needs it.
+    Once a message has been broadcast, compact() cuts it down to just its full frame for the time it
+    spends in the replay buffer.
+    """
+    __slots__ = ('seq', 'seen', '_all_domains', '_packet', '_frames', '_compacted')
+
+    def __init__(self, data_packet):
+        self.seq = data_packet['seq']
+        self.seen = data_packet['data'].get('seen')
+        self._all_domains = None
+        self._packet = data_packet
+        self._frames = {}
+        self._compacted = False
+
+    @classmethod
+    def from_encoded(cls, seq, data_json, seen=None, all_domains=None):
+        message = cls.__new__(cls)
+        message.seq = seq
+        message.seen = seen
+        message._all_domains = all_domains
+        message._packet = None
+        message._compacted = False
+
+        started = time.monotonic()
+        # Byte for byte what json.dumps() would produce for the whole packet
+        message._frames = {'full': '{{"message_type": "certificate_update", "seq": {}, "data": {}}}'.format(seq, data_json)}
+        ENCODE_SECONDS['full'].observe(time.monotonic() - started)
+
+        return message
+
+    @property
+    def packet(self):
+        packet = self._packet
+        if packet is None:
+            packet = json.loads(self._frames['full'])
+            if not self._compacted:
+                self._packet = packet
+        return packet
+
+    @property
+    def all_domains(self):
+        if self._all_domains is not None:
+            return self._all_domains
+        return self.packet['data']['leaf_cert']['all_domains']
+
+    @property
+    def size(self):
+        return sum(len(frame) for frame in self._frames.values())
+
+    def frame(self, stream_type='full'):
+        frame = self._frames.get(stream_type)
+        if frame is None:
+            started = time.monotonic()
+            frame = json.dumps(PACKET_BUILDERS[stream_type](self.packet))
+            # Compacted messages are only read for the odd replay or /latest.json, which isn't worth growing
+            # them back for
+            if not self._compacted:
+                self._frames[stream_type] = frame
+            ENCODE_SECONDS[stream_type].observe(time.monotonic() - started)
+        return frame
+
+    def compact(self):
+        full_frame = self.frame()
+        self._all_domains = self.all_domains
+        self._packet = None
+        self._frames = {'full': full_frame}
+        self._compacted = True
+        return self
+
+
+class StreamQueue(asyncio.Queue):
+    """
+    The queue between whatever produces certificates and whatever broadcasts them, bounded by the encoded
+    size of what's in it rather than by a number of entries, so an issuance spike of large certificates
+    can't balloon memory. Anything put on it needs a size. Like any asyncio.Queue, put() waits while it's
+    full, which pushes back on the log pollers.
+    """
+    def __init__(self, max_bytes=None, maxsize=0):
+        super(StreamQueue, self).__init__(maxsize=maxsize)
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("STREAM_QUEUE_BYTES", 64 * 1024 * 1024))
+        self.size_bytes = 0
+
+    def _put(self, item):
+        super(StreamQueue, self)._put(item)
+        self.size_bytes += item.size
+
+    def _get(self):
+        item = super(StreamQueue, self)._get()
+        self.size_bytes -= item.size
+        return item
+
+    def full(self):
+        return super(StreamQueue, self).full() or (self.max_bytes > 0 and self.size_bytes >= self.max_bytes)
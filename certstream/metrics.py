@@ -0,0 +1,222 @@
+import bisect
+import logging
+import math
+import os
+
+from aiohttp import web
+
+from certstream.util import get_rss
+
+# Latency buckets in seconds, wide enough to cover both a sub-millisecond parse and a stalled CT log
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def _format_labels(label_names, label_values, extra=''):
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric(object):
+    """
+    Base for every metric. Labelled metrics hand out one child per distinct set of label values, callers
+    on a hot path are expected to look their child up once and keep it so recording a sample never
+    allocates anything.
+    """
+    metric_type = None
+
+    def __init__(self, name, documentation, labels=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.children = {}
+
+        if not self.label_names:
+            self._init_child()
+
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *label_values):
+        child = self.children.get(label_values)
+        if child is None:
+            child = self.children[label_values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        child = self.__class__.__new__(self.__class__)
+        child._init_child()
+        return child
+
+    def _init_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        if not self.label_names:
+            return self._child_samples(self, ())
+        return [sample for label_values, child in list(self.children.items()) for sample in self._child_samples(child, label_values)]
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.metric_type),
+        ]
+        for suffix, label_values, extra, value in self._samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, _format_labels(self.label_names, label_values, extra), _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def _init_child(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def _child_samples(self, child, label_values):
+        return [('', label_values, '', child.value)]
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def _init_child(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        # Sampled when scraped rather than kept up to date, for values that are cheaper to read than to track
+        self.function = function
+
+    def _child_samples(self, child, label_values):
+        return [('', label_values, '', child.function() if child.function is not None else child.value)]
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labels, registry)
+
+    def _new_child(self):
+        child = self.__class__.__new__(self.__class__)
+        child.buckets = self.buckets
+        child._init_child()
+        return child
+
+    def _init_child(self):
+        # The last slot is the implicit +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def _child_samples(self, child, label_values):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), child.counts):
+            cumulative += count
+            samples.append(('_bucket', label_values, 'le="{}"'.format(_format_value(bound)), cumulative))
+        samples.append(('_sum', label_values, '', child.sum))
+        samples.append(('_count', label_values, '', cumulative))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+# Polling the logs
+STH_LATENCY = Histogram('certstream_sth_latency_seconds', 'Time taken by get-sth requests.', labels=('log',))
+TREE_LAG = Gauge('certstream_tree_lag_entries', 'Entries the log has that we have not emitted yet (tree_size - latest_size).', labels=('log',))
+GET_ENTRIES_LATENCY = Histogram('certstream_get_entries_latency_seconds', 'Time taken by get-entries requests.', labels=('log',))
+ENTRIES_FETCHED = Counter('certstream_entries_fetched_total', 'Entries retrieved from each log, rate() this for entries per second.', labels=('log',))
+POLL_INTERVAL = Gauge('certstream_poll_interval_seconds', 'Current get-sth poll interval for each log.', labels=('log',))
+LOG_ERRORS = Counter('certstream_log_errors_total', 'Failed requests to each log.', labels=('log',))
+LOG_DEMOTED = Gauge('certstream_log_demoted', 'Whether each log has failed often enough to only be retried occasionally.', labels=('log',))
+
+BACKFILL_ENTRIES = Counter('certstream_backfill_entries_total', 'Entries fetched by backfill jobs.')
+
+# Parsing
+PARSE_BATCH_SECONDS = Histogram('certstream_parse_batch_seconds', 'Time spent in parse_ctl_entry for a get-entries batch.')
+ENCODE_BATCH_SECONDS = Histogram('certstream_encode_batch_seconds', 'Time spent encoding a parsed get-entries batch for the stream.')
+PARSED_ENTRIES = Counter('certstream_parsed_entries_total', 'Entries run through parse_ctl_entry.')
+
+# Deduplication
+DEDUP_DUPLICATES = Counter('certstream_dedup_duplicates_total', 'Certificates not broadcast because the same issuance was already seen.')
+DEDUP_KEYS = Gauge('certstream_dedup_keys', 'Issuer and serial keys remembered for deduplication.')
+DEDUP_PENDING = Gauge('certstream_dedup_pending', 'Certificates held back while further sightings are merged into them.')
+
+# Broadcasting
+STREAM_QUEUE_DEPTH = Gauge('certstream_stream_queue_depth', 'Certificates waiting on the watcher stream.')
+STREAM_QUEUE_BYTES = Gauge('certstream_stream_queue_bytes', 'Encoded size of the certificates waiting on the watcher stream.')
+ENCODE_SECONDS = Histogram('certstream_encode_seconds', 'Time taken to encode a certificate into a frame.', labels=('stream_type',))
+BROADCAST_LATENCY = Histogram('certstream_broadcast_latency_seconds', 'Time from a certificate being seen to it being queued for clients.')
+CLIENT_QUEUE_WAIT = Histogram('certstream_client_queue_wait_seconds', 'Time frames spend in a client queue before being sent.')
+CLIENT_DROPPED = Counter('certstream_client_dropped_frames_total', 'Frames dropped because a client queue was full.')
+CLIENT_DISCONNECTS = Counter('certstream_client_overflow_disconnects_total', 'Clients disconnected for falling too far behind.')
+CONNECTED_CLIENTS = Gauge('certstream_connected_clients', 'Connected websocket clients.')
+CLIENT_QUEUED_FRAMES = Gauge('certstream_client_queued_frames', 'Frames waiting across all client queues.')
+CLIENT_QUEUED_BYTES = Gauge('certstream_client_queued_bytes', 'Bytes waiting across all client queues.')
+CLIENT_MAX_QUEUE_DEPTH = Gauge('certstream_client_max_queue_depth', 'Deepest single client queue.')
+CLIENT_MAX_LAG = Gauge('certstream_client_max_lag_seconds', 'Age of the oldest frame in any client queue.')
+REPLAY_BUFFER_BYTES = Gauge('certstream_replay_buffer_bytes', 'Encoded size of the messages held for replay.')
+
+# Archive
+ARCHIVE_BYTES = Gauge('certstream_archive_bytes', 'Size on disk of the certificate archive segments.')
+ARCHIVE_SEARCH_SECONDS = Histogram('certstream_archive_search_seconds', 'Time taken to answer an archive search.')
+ARCHIVE_DROPPED = Counter('certstream_archive_dropped_total', 'Certificates left out of the archive because its writer fell behind.')
+
+# The process itself
+RESIDENT_MEMORY = Gauge('certstream_resident_memory_bytes', 'Resident set size of this process.')
+RESIDENT_MEMORY.set_function(get_rss)
+
+
+async def metrics_handler(_):
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+async def serve_metrics(_loop, port=None):
+    """
+    Processes without a websocket server of their own (an ingest node, or the watcher side of a WEB_WORKERS
+    setup) can still be scraped if METRICS_PORT is set.
+    """
+    if port is None:
+        port = os.getenv("METRICS_PORT")
+        if not port:
+            return
+
+    app = web.Application(loop=_loop)
+    app.router.add_get('/metrics', metrics_handler)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=int(port)).start()
+
+    logging.getLogger('certstream.metrics').info("Serving metrics on port {}".format(port))
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import os
+import time
+
+import aioprocessing
+
+from certstream import certlib, fastparse, metrics
+from certstream.certlib import chain_cache, parse_ctl_entries
+from certstream.messages import EncodedCertificate
+from certstream.tracing import lap
+
+PARSER_BACKENDS = {
+    'construct': certlib.parse_ctl_entry,
+    'fast': fastparse.parse_ctl_entry,
+}
+
+
+def _encode(entry, cert_data):
+    trace = entry.get('trace')
+    if trace is None:
+        return EncodedCertificate(cert_data)
+
+    started = time.perf_counter()
+    record = EncodedCertificate(cert_data)
+    lap(trace['spans'], 'json_encode', started)
+    record.trace = trace
+    return record
+
+
+def _parse_batch(entries, operator_information, parse_entry):
+    # Usually runs inside a worker, the cache counters and timings ride along with each result so the
+    # parent can report them
+    started = time.monotonic()
+    parsed_entries = parse_ctl_entries(entries, operator_information, parse_entry)
+    parsed = time.monotonic()
+    records = [_encode(entry, cert_data) for entry, cert_data in zip(entries, parsed_entries)]
+    return os.getpid(), chain_cache.stats(), parsed - started, time.monotonic() - parsed, records
+
+
+class ParsingPipeline(object):
+    def __init__(self, _loop, workers=None, max_in_flight=None, backend=None):
+        self.loop = _loop
+        self.logger = logging.getLogger('certstream.pipeline')
+
+        if backend is None:
+            backend = os.getenv("PARSER_BACKEND", "construct")
+
+        if backend not in PARSER_BACKENDS:
+            raise ValueError("Unknown parser backend {}, expected one of {}".format(backend, ", ".join(PARSER_BACKENDS)))
+
+        self.backend = backend
+        self.parse_entry = PARSER_BACKENDS[backend]
+
+        if workers is None:
+            workers = int(os.getenv("PARSE_WORKERS", 0))
+
+        if max_in_flight is None:
+            max_in_flight = int(os.getenv("PARSE_MAX_IN_FLIGHT", max(workers * 2, 1)))
+
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.pool = None
+
+        self.worker_cache_stats = {}
+
+    def start(self):
+        # Zero workers keeps the old behaviour of parsing inline on the event loop
+        if self.workers > 0 and self.pool is None:
+            self.logger.info("Starting {} parsing pool with {} workers ({} batches in flight)".format(self.backend, self.workers, self.max_in_flight))
+            self.pool = aioprocessing.AioPool(processes=self.workers)
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    async def submit(self, entries, operator_information):
+        """
+        Queue a get-entries batch for parsing and return a future resolving to a list of
+        EncodedCertificate records. Blocks while max_in_flight batches are already being parsed, which is what pushes
+        back on the fetchers when the workers can't keep up.
+        """
+        await self.in_flight.acquire()
+
+        if self.pool is None:
+            future = self.loop.create_future()
+            try:
+                future.set_result(self._finish_batch(_parse_batch(entries, operator_information, self.parse_entry)))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            future = self.loop.create_future()
+            self.pool.coro_apply(_parse_batch, (entries, operator_information, self.parse_entry), loop=self.loop).add_done_callback(
+                lambda batch: self._unwrap_batch(batch, future)
+            )
+
+        future.add_done_callback(lambda _: self.in_flight.release())
+
+        return future
+
+    def _unwrap_batch(self, batch, future):
+        if future.cancelled():
+            return
+
+        if batch.exception() is not None:
+            future.set_exception(batch.exception())
+            return
+
+        future.set_result(self._finish_batch(batch.result()))
+
+    def _finish_batch(self, batch):
+        pid, cache_stats, parse_seconds, encode_seconds, records = batch
+        self.worker_cache_stats[pid] = cache_stats
+        metrics.PARSE_BATCH_SECONDS.observe(parse_seconds)
+        metrics.ENCODE_BATCH_SECONDS.observe(encode_seconds)
+        metrics.PARSED_ENTRIES.inc(len(records))
+        return records
+
+    def chain_cache_stats(self):
+        if self.pool is None:
+            return chain_cache.stats()
+
+        totals = {"size": 0, "max_size": 0, "hits": 0, "misses": 0}
+        for cache_stats in self.worker_cache_stats.values():
+            for key in totals:
+                totals[key] += cache_stats[key]
+        return totals
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import struct
+import time
+
+from certstream import metrics
+from certstream.messages import CertificateMessage, StreamQueue
+from certstream.tracing import TRACER, lap
+
+# Every relayed frame is the length of its payload, its sequence number and when the certificate was seen,
+# followed by the certificate data as UTF-8 encoded JSON
+FRAME_HEADER = struct.Struct('>IQd')
+
+
+def _parse_address(address):
+    if address.startswith('unix:'):
+        return address[len('unix:'):], None
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class FramePublisher(object):
+    """
+    Ingest side of a split deployment. Takes certificates off the watcher's stream, sequences and encodes
+    each of them exactly once, and writes the resulting frame to every connected edge node.
+    """
+    def __init__(self, _loop, transparency_watcher, address=None):
+        self.loop = _loop
+        self.watcher = transparency_watcher
+        self.logger = logging.getLogger('certstream.relay')
+
+        self.address = address or os.getenv("RELAY_ADDRESS", "127.0.0.1:8081")
+        self.max_buffer = int(os.getenv("RELAY_MAX_BUFFER", 64 * 1024 * 1024))
+
+        self.subscribers = []
+        # Set while at least one edge is subscribed
+        self.subscribed = asyncio.Event()
+        self.server = None
+
+        # Seeded from the clock rather than 0 so sequence numbers keep going up across restarts of this
+        # node, and edges that stayed up can keep replaying from them. A thousand a millisecond is far more
+        # than we'll ever publish, and it stays under 2^53, the most JSON clients can be trusted with.
+        self.last_seq = int(time.time() * 1000) * 1000
+
+    def get_tasks(self):
+        return [self.serve(), self.publish_stream()]
+
+    async def serve(self):
+        path, port = _parse_address(self.address)
+        if port is None:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.server = await asyncio.start_unix_server(self._handle_subscriber, path=path)
+        else:
+            self.server = await asyncio.start_server(self._handle_subscriber, host=path, port=port)
+        self.logger.info("Publishing certificate frames on {}".format(self.address))
+
+    async def _handle_subscriber(self, reader, writer):
+        peer = writer.get_extra_info('peername') or self.address
+        self.logger.info("Edge {} subscribed.".format(peer))
+        self.subscribers.append(writer)
+        self.subscribed.set()
+        try:
+            # Edges never send us anything, this just waits for them to hang up
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self._unsubscribe(writer)
+            writer.close()
+            self.logger.info("Edge {} unsubscribed.".format(peer))
+
+    def _unsubscribe(self, writer):
+        if writer in self.subscribers:
+            self.subscribers.remove(writer)
+        if not self.subscribers:
+            self.subscribed.clear()
+
+    def _write(self, frame):
+        """
+        Write a frame to every subscribed edge, returning whether any of them got it.
+        """
+        for writer in list(self.subscribers):
+            # An edge that stopped reading gets cut off rather than buffering without bound, it'll
+            # reconnect and its clients can fill the hole with ?since=
+            if writer.transport.get_write_buffer_size() > self.max_buffer:
+                self.logger.warning("Edge {} fell too far behind, disconnecting.".format(writer.get_extra_info('peername')))
+                self._unsubscribe(writer)
+                writer.transport.abort()
+                continue
+            writer.write(frame)
+        return bool(self.subscribers)
+
+    async def publish_stream(self):
+        while True:
+            # Nothing comes off the stream until an edge is there to take it, otherwise certificates polled
+            # before the first edge connects (always the case when starting with WEB_WORKERS) would be
+            # checkpointed without anyone having seen them. Polling pauses once the stream fills up.
+            await self.subscribed.wait()
+            record = await self.watcher.stream.get()
+
+            trace = record.trace
+            if trace is not None:
+                trace['spans']['stream_queue_wait'] = time.monotonic() - trace['enqueued']
+                started = time.perf_counter()
+
+            # The certificate was encoded when it was parsed, all that's left is to frame it
+            self.last_seq += 1
+            payload = record.data_json.encode('utf-8')
+            frame = FRAME_HEADER.pack(len(payload), self.last_seq, record.seen or 0.0) + payload
+
+            # Hold on to the frame until some edge has actually had it
+            while not self._write(frame):
+                await self.subscribed.wait()
+
+            self.watcher.done(record)
+
+            if trace is not None:
+                lap(trace['spans'], 'relay_publish', started)
+                trace['edges'] = len(self.subscribers)
+                TRACER.record(trace)
+
+
+class RelayWatcher(object):
+    """
+    Stands in for TransparencyWatcher on an edge node. Instead of polling the logs it subscribes to an
+    ingest node and feeds the already sequenced and encoded messages straight to the WebServer.
+    """
+    def __init__(self, _loop, address=None):
+        self.loop = _loop
+        self.stopped = False
+        self.logger = logging.getLogger('certstream.relay')
+
+        self.address = address or os.getenv("RELAY_ADDRESS", "127.0.0.1:8081")
+        self.stream = StreamQueue()
+        metrics.STREAM_QUEUE_DEPTH.set_function(self.stream.qsize)
+        metrics.STREAM_QUEUE_BYTES.set_function(lambda: self.stream.size_bytes)
+
+    def get_tasks(self):
+        return [self.subscribe_task()]
+
+    def stop(self):
+        self.stopped = True
+
+    async def subscribe_task(self):
+        path, port = _parse_address(self.address)
+        while not self.stopped:
+            try:
+                if port is None:
+                    reader, writer = await asyncio.open_unix_connection(path=path)
+                else:
+                    reader, writer = await asyncio.open_connection(host=path, port=port)
+
+                self.logger.info("Subscribed to ingest node at {}".format(self.address))
+
+                try:
+                    while True:
+                        length, seq, seen = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                        payload = await reader.readexactly(length)
+                        await self.stream.put(CertificateMessage.from_encoded(seq, payload.decode('utf-8'), seen or None))
+                finally:
+                    writer.close()
+
+            except (OSError, asyncio.IncompleteReadError) as e:
+                self.logger.info("Lost ingest node at {}, reconnecting -> {}".format(self.address, e))
+                await asyncio.sleep(1)
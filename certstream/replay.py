@@ -0,0 +1,72 @@
+import collections
+import itertools
+import os
+
+
+class ReplayBuffer(object):
+    """
+    Fixed size ring of the most recent certificate messages, bounded both by entry count and by the size
+    of their encoded frames, so reconnecting clients can ask for everything after the last sequence number
+    they saw.
+    """
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv("REPLAY_BUFFER_SIZE", 100000))
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("REPLAY_BUFFER_BYTES", 256 * 1024 * 1024))
+
+        self.messages = collections.deque()
+        self.size_bytes = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    @property
+    def first_seq(self):
+        return self.messages[0].seq if self.messages else None
+
+    @property
+    def last_seq(self):
+        return self.messages[-1].seq if self.messages else None
+
+    def append(self, message):
+        if self.max_entries <= 0:
+            return
+
+        self.messages.append(message)
+        self.size_bytes += len(message.frame())
+
+        while len(self.messages) > self.max_entries or (self.max_bytes > 0 and self.size_bytes > self.max_bytes and len(self.messages) > 1):
+            self.size_bytes -= len(self.messages.popleft().frame())
+
+    def clear(self):
+        self.messages.clear()
+        self.size_bytes = 0
+
+    def _offset_after(self, seq):
+        # Sequence numbers are normally contiguous, making this a plain offset, but a relayed stream can
+        # have holes in it (e.g. while reconnecting to the ingest node) so fall back to a binary search
+        offset = seq + 1 - self.messages[0].seq
+        if offset <= 0:
+            return 0
+        if offset <= len(self.messages) and self.messages[offset - 1].seq == seq:
+            return offset
+        if self.messages[-1].seq <= seq:
+            return len(self.messages)
+
+        low, high = 0, len(self.messages)
+        while low < high:
+            middle = (low + high) // 2
+            if self.messages[middle].seq <= seq:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def since(self, seq, limit=1000):
+        """
+        Up to `limit` messages with a sequence number greater than `seq`, oldest first.
+        """
+        if not self.messages:
+            return []
+
+        offset = self._offset_after(seq)
+        return list(itertools.islice(self.messages, offset, offset + limit))
@@ -0,0 +1,167 @@
+import asyncio
+import os
+import random
+import time
+
+from certstream import metrics
+
+
+class LogSchedule(object):
+    """
+    When to next poll one log's get-sth. Busy logs are polled about as often as it takes them to grow by
+    target_entries, but never much faster than they publish new tree heads, idle logs drift out towards
+    the maximum interval and failing ones back off exponentially with jitter. A log that keeps failing is
+    demoted to being tried every demoted_interval until it answers again.
+    """
+    # Weight given to the newest sample in the growth rate and STH period averages
+    SMOOTHING = 0.3
+
+    # How much further apart polls get each time a log shows nothing new
+    IDLE_FACTOR = 1.5
+
+    def __init__(self, scheduler, operator_information):
+        self.scheduler = scheduler
+        self.url = operator_information['url']
+        self.name = operator_information.get('description', self.url)
+
+        # Never wait longer than the log's own maximum merge delay
+        mmd = operator_information.get('maximum_merge_delay')
+        self.max_interval = min(scheduler.max_interval, mmd) if mmd else scheduler.max_interval
+
+        self.interval = scheduler.initial_interval
+        self.next_poll = time.monotonic()
+        self.failures = 0
+
+        self.tree_size = None
+        self.sth_timestamp = None
+        self.growth_rate = None
+        self.sth_period = None
+
+        self.polls = 0
+        self.unchanged_polls = 0
+
+        self.interval_gauge = metrics.POLL_INTERVAL.labels(self.url)
+        self.interval_gauge.set(self.interval)
+        self.demoted_gauge = metrics.LOG_DEMOTED.labels(self.url)
+        self.demoted_gauge.set(0)
+
+    @property
+    def demoted(self):
+        # demote_after of 0 never demotes anything
+        return 0 < self.scheduler.demote_after <= self.failures
+
+    async def wait(self):
+        delay = self.next_poll - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.next_poll = time.monotonic() + self.interval
+        self.polls += 1
+
+    def _reschedule(self, interval):
+        # next_poll was set from the start of this poll, so a long catch up doesn't delay the next one
+        self.next_poll += interval - self.interval
+        self.interval = interval
+        self.interval_gauge.set(interval)
+
+    def record_sth(self, tree_size, timestamp):
+        """
+        Feed a successful get-sth response (timestamp in milliseconds, as the log reports it) into the
+        schedule. Returns True if this brought a demoted log back.
+        """
+        promoted = self.demoted
+        self.failures = 0
+        self.demoted_gauge.set(0)
+        first_sth = self.sth_timestamp is None
+
+        if not first_sth and timestamp is not None and timestamp > self.sth_timestamp:
+            elapsed = (timestamp - self.sth_timestamp) / 1000
+            self.sth_period = self._smooth(self.sth_period, elapsed)
+            self.growth_rate = self._smooth(self.growth_rate, max(tree_size - self.tree_size, 0) / elapsed)
+            self.unchanged_polls = 0
+        elif not first_sth:
+            self.unchanged_polls += 1
+
+        self.tree_size = tree_size
+        self.sth_timestamp = timestamp
+
+        if first_sth:
+            interval = self.scheduler.initial_interval
+        elif self.unchanged_polls or not self.growth_rate:
+            interval = self.interval * self.IDLE_FACTOR
+        else:
+            interval = self.scheduler.target_entries / self.growth_rate
+
+        # Asking more often than the log signs new tree heads just gets us the same one again
+        if self.sth_period:
+            interval = max(interval, self.sth_period / 2)
+
+        self._reschedule(min(max(interval, self.scheduler.min_interval), self.max_interval))
+
+        return promoted
+
+    def record_failure(self):
+        """
+        Back off after a failed request. Returns True if this failure got the log demoted.
+        """
+        self.failures += 1
+        if self.demoted:
+            backoff = self.scheduler.demoted_interval
+            self.demoted_gauge.set(1)
+        else:
+            backoff = min(self.scheduler.backoff_base * 2 ** (self.failures - 1), self.scheduler.backoff_max)
+        # Equal jitter, so logs that fell over together don't all come back at once
+        self._reschedule(backoff / 2 + random.uniform(0, backoff / 2))
+
+        return self.failures == self.scheduler.demote_after
+
+    def _smooth(self, average, sample):
+        if average is None:
+            return sample
+        return self.SMOOTHING * sample + (1 - self.SMOOTHING) * average
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "interval": round(self.interval, 2),
+            "next_poll_in": round(max(self.next_poll - time.monotonic(), 0), 2),
+            "failures": self.failures,
+            "demoted": self.demoted,
+            "tree_size": self.tree_size,
+            "growth_rate": round(self.growth_rate, 3) if self.growth_rate is not None else None,
+            "sth_period": round(self.sth_period, 1) if self.sth_period is not None else None,
+            "polls": self.polls,
+        }
+
+
+class PollScheduler(object):
+    """
+    Keeps the poll schedule of every log in one place and caps the number of requests outstanding against
+    all of the logs put together.
+    """
+    def __init__(self, initial_interval=None, min_interval=None, max_interval=None, target_entries=None,
+                 backoff_base=None, backoff_max=None, max_outstanding=None, demote_after=None, demoted_interval=None):
+        self.initial_interval = initial_interval if initial_interval is not None else float(os.getenv("STH_POLL_INTERVAL", 30))
+        self.min_interval = min_interval if min_interval is not None else float(os.getenv("STH_POLL_MIN_INTERVAL", 2))
+        self.max_interval = max_interval if max_interval is not None else float(os.getenv("STH_POLL_MAX_INTERVAL", 300))
+        self.target_entries = target_entries if target_entries is not None else int(os.getenv("STH_POLL_TARGET_ENTRIES", 256))
+        self.backoff_base = backoff_base if backoff_base is not None else float(os.getenv("STH_BACKOFF_BASE", 10))
+        self.backoff_max = backoff_max if backoff_max is not None else float(os.getenv("STH_BACKOFF_MAX", 900))
+        self.demote_after = demote_after if demote_after is not None else int(os.getenv("LOG_DEMOTE_AFTER", 5))
+        self.demoted_interval = demoted_interval if demoted_interval is not None else float(os.getenv("LOG_DEMOTED_INTERVAL", 3600))
+
+        max_outstanding = max_outstanding if max_outstanding is not None else int(os.getenv("CT_MAX_OUTSTANDING_REQUESTS", 64))
+        self.request_slots = asyncio.Semaphore(max_outstanding)
+
+        self.schedules = {}
+
+    def add(self, operator_information):
+        schedule = self.schedules[operator_information['url']] = LogSchedule(self, operator_information)
+        return schedule
+
+    def remove(self, url):
+        schedule = self.schedules.pop(url, None)
+        if schedule is not None:
+            schedule.demoted_gauge.set(0)
+
+    def stats(self):
+        return {url: schedule.stats() for url, schedule in self.schedules.items()}
@@ -0,0 +1,128 @@
+import collections
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+
+def lap(spans, name, started):
+    """
+    Close the span `name` that began at `started` and return the start of the next one. Does nothing for
+    entries that aren't being traced (spans is None), so it can sit on the hot path.
+    """
+    if spans is None:
+        return None
+    now = time.perf_counter()
+    spans[name] = now - started
+    return now
+
+
+class Tracer(object):
+    """
+    Per-entry tracing for a sample of certificates. A sampled entry gets a trace attached as soon as it's
+    fetched, each stage it goes through (fetching, decoding, loading and serializing the certificate,
+    working out its domains, encoding, waiting on the stream and being fanned out to clients) adds how
+    long it took, and the finished trace is kept in a ring of the last TRACE_RING_SIZE and, if TRACE_FILE
+    is set, appended to that file as a line of JSON. Websocket sends are sampled on their own, as one send
+    covers many clients' worth of frames.
+    """
+    def __init__(self, sample_rate=None, path=None, ring_size=None):
+        self.logger = logging.getLogger('certstream.tracing')
+
+        self.sample_rate = sample_rate if sample_rate is not None else float(os.getenv("TRACE_SAMPLE_RATE", 0))
+        self.path = path if path is not None else os.getenv("TRACE_FILE")
+        self.ring = collections.deque(maxlen=ring_size if ring_size is not None else int(os.getenv("TRACE_RING_SIZE", 10000)))
+        self.file = None
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def sampled(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def sample(self, entries, log_url, start, fetch_seconds):
+        """
+        Attach a trace to a sample of a freshly fetched get-entries page. The trace travels with the entry
+        into the parsing workers and comes back on its EncodedCertificate.
+        """
+        if not self.sample_rate:
+            return
+        for offset, entry in enumerate(entries):
+            if random.random() < self.sample_rate:
+                entry['trace'] = {
+                    "log": log_url,
+                    "cert_index": start + offset,
+                    "seen": time.time(),
+                    "spans": {"fetch": fetch_seconds},
+                }
+
+    def record(self, trace):
+        trace.pop('enqueued', None)
+        self.ring.append(trace)
+
+        if self.path:
+            try:
+                if self.file is None:
+                    self.file = open(self.path, 'a', buffering=1)
+                self.file.write(json.dumps(trace) + '\n')
+            except OSError as e:
+                self.logger.warning("Unable to write to trace file {}, only keeping traces in memory -> {}".format(self.path, e))
+                self.path = None
+
+    def record_send(self, seconds, stream_type, frames=1):
+        self.record({"kind": "websocket_send", "seen": time.time(), "stream_type": stream_type, "frames": frames, "spans": {"websocket_send": seconds}})
+
+    def recent(self, limit=None):
+        traces = list(self.ring)
+        return traces[-limit:] if limit else traces
+
+
+TRACER = Tracer()
+
+
+class StackSampler(object):
+    """
+    Statistical profiler for the thread running the event loop. A background thread looks at that
+    thread's Python stack every `interval` seconds and counts how often each distinct stack comes up,
+    which collapsed() renders in the folded format flamegraph.pl and speedscope read.
+    """
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='certstream-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+
+            self.counts[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return ''.join("{} {}\n".format(stack, count) for stack, count in self.counts.most_common())
@@ -1,5 +1,51 @@
+import asyncio
+import logging
+import os
+import resource
+import signal
+import tempfile
 from datetime import datetime
 
+
+def run_until_signalled(loop, coroutines):
+    """
+    Run coroutines on loop until they finish, or until SIGINT or SIGTERM cancels them so the caller can
+    clean up after them.
+    """
+    tasks = asyncio.gather(*coroutines)
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, tasks.cancel)
+
+    try:
+        loop.run_until_complete(tasks)
+    except asyncio.CancelledError:
+        logging.getLogger('certstream').info("Got stop order, exiting...")
+
+
+def atomic_write(path, data):
+    """
+    Replace the file at path with data (bytes, or a str to be written as UTF-8) so that a crash at any
+    point leaves either the old contents or the new ones, never a mix. Raises OSError if it couldn't.
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except OSError:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
 def pretty_date(time=False):
     """
     Get a datetime object or a int() Epoch timestamp and return a
@@ -53,4 +99,15 @@ def get_ip(request):
     if 'X-Forwarded-For' in request.headers:
         ip = request.headers.get('X-Forwarded-For')
 
-    return ip
\ No newline at end of file
+    return ip
+
+def get_rss():
+    """
+    Resident set size of this process in bytes. Only Linux has the current value handy, elsewhere this
+    is the peak instead.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -1,174 +1,375 @@
 import aiohttp
 import asyncio
+import collections
 import logging
-import math
-import requests
-import sys
 import os
+import time
 
-from certstream.certlib import parse_ctl_entry
+from certstream import metrics
+from certstream.blocksizes import BlockSizes
+from certstream.checkpoints import CheckpointStore
+from certstream.dedup import Deduplicator
+from certstream.loglist import LogList
+from certstream.messages import StreamQueue
+from certstream.pipeline import ParsingPipeline
+from certstream.scheduler import PollScheduler
+from certstream.tracing import TRACER
+
+# Each log's metric children, looked up once when we start watching it
+LogMetrics = collections.namedtuple('LogMetrics', ['sth_latency', 'tree_lag', 'get_entries_latency', 'entries_fetched', 'errors'])
 
 
 class TransparencyWatcher(object):
-    # These are a list of servers that we shouldn't even try to connect to. In testing they either had bad
-    # DNS records, resolved to un-routable IP addresses, or didn't have valid SSL certificates.
-    BAD_CT_SERVERS = [
-        "alpha.ctlogs.org",
-        "clicky.ct.letsencrypt.org",
-        "ct.akamai.com",
-        "ct.filippo.io/behindthesofa",
-        "ct.gdca.com.cn",
-        "ct.izenpe.com",
-        "ct.izenpe.eus",
-        "ct.sheca.com",
-        "ct.startssl.com",
-        "ct.wosign.com",
-        "ctlog.api.venafi.com",
-        "ctlog.gdca.com.cn",
-        "ctlog.sheca.com",
-        "ctlog.wosign.com",
-        "ctlog2.wosign.com",
-        "flimsy.ct.nordu.net:8080",
-        "log.certly.io",
-        "nessie2021.ct.digicert.com/log",
-        "plausible.ct.nordu.net",
-        "www.certificatetransparency.cn/ct",
-    ]
-
-    MAX_BLOCK_SIZE = 64
+    MAX_BLOCK_SIZE = int(os.getenv("FETCH_MAX_BLOCK_SIZE", 1024))
+    FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", 4))
+
+    # How far behind a checkpoint is allowed to be before we give up on catching up fully after a restart
+    MAX_CATCHUP = int(os.getenv("CHECKPOINT_MAX_CATCHUP", 100000))
+
+    # First wait before retrying a failed log list download, doubling up to the refresh interval
+    LOG_LIST_RETRY_INTERVAL = 60
 
     def __init__(self, _loop):
         self.loop = _loop
         self.stopped = False
         self.logger = logging.getLogger('certstream.watcher')
 
-        self.stream = asyncio.Queue(maxsize=3000)
+        # The page size each log actually hands back to us
+        self.block_sizes = BlockSizes(self.MAX_BLOCK_SIZE)
 
-        self.logger.info("Initializing the CTL watcher")
+        self.session = None
 
-    def _initialize_ts_logs(self):
-        try:
-            self.transparency_logs = requests.get('https://www.gstatic.com/ct/log_list/all_logs_list.json').json()
-        except Exception as e:
-            self.logger.fatal("Invalid response from certificate directory! Exiting :(")
-            sys.exit(1)
+        self.log_metrics = {}
+
+        self.stream = StreamQueue()
+        metrics.STREAM_QUEUE_DEPTH.set_function(self.stream.qsize)
+        metrics.STREAM_QUEUE_BYTES.set_function(lambda: self.stream.size_bytes)
+
+        self.pipeline = ParsingPipeline(self.loop)
+        self.checkpoints = CheckpointStore()
+        self.scheduler = PollScheduler()
+        self.dedup = Deduplicator()
+
+        self.log_list = LogList()
+        self.transparency_logs = {"logs": []}
+        # The task watching each log, keyed by log url
+        self.log_tasks = {}
 
-        self.logger.info("Retrieved transparency log with {} entries to watch.".format(len(self.transparency_logs['logs'])))
-        for entry in self.transparency_logs['logs']:
-            if entry['url'].endswith('/'):
-                entry['url'] = entry['url'][:-1]
-            self.logger.info("  + {}".format(entry['description']))
+        self.logger.info("Initializing the CTL watcher")
+
+    async def watch_log_list_task(self):
+        """
+        Start watching whatever the local log list has in it, then keep the list (and with it the set of
+        logs we watch) up to date in the background.
+        """
+        logs = self.log_list.load()
+        if logs is not None:
+            self._update_logs(logs)
+        elif not self.log_list.url:
+            self.logger.error("No log list at {} and CT_LOG_LIST_URL is empty, nothing to watch until there is one".format(self.log_list.path))
+
+        retry_interval = self.LOG_LIST_RETRY_INTERVAL
+
+        while not self.stopped:
+            if not self.log_list.url:
+                # Nothing to download, but the local file may have been edited since
+                await asyncio.sleep(self.log_list.refresh_interval)
+                logs = self.log_list.load()
+                if logs is not None:
+                    self._update_logs(logs)
+                continue
+
+            try:
+                logs = await self.log_list.fetch(self._get_session())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.logger.warning("Unable to refresh the log list from {} -> {}, retrying in {:.0f}s".format(self.log_list.url, e, retry_interval))
+                await asyncio.sleep(retry_interval)
+                retry_interval = min(retry_interval * 2, self.log_list.refresh_interval)
+                continue
+
+            retry_interval = self.LOG_LIST_RETRY_INTERVAL
+            self._update_logs(logs)
+            await asyncio.sleep(self.log_list.refresh_interval)
+
+    def _update_logs(self, logs):
+        logs = {log['url']: log for log in logs}
+        changed = False
+
+        for url in set(self.log_tasks) - set(logs):
+            self.logger.info("  - {}".format(url))
+            self.log_tasks.pop(url).cancel()
+            self.scheduler.remove(url)
+            changed = True
+
+        for url, log in logs.items():
+            # A watcher that died on an unexpected error gets another go every refresh
+            if url not in self.log_tasks or self.log_tasks[url].done():
+                self.logger.info("  + {}".format(log['description']))
+                self.log_tasks[url] = asyncio.ensure_future(self.watch_for_updates_task(log), loop=self.loop)
+                changed = True
+
+        self.transparency_logs = {"logs": list(logs.values())}
+        if changed:
+            self.logger.info("Watching {} transparency logs".format(len(self.log_tasks)))
+
+    def _get_session(self):
+        # One long-lived pooled session for every log, so polls reuse keep-alive connections and cached DNS
+        # instead of paying a fresh TCP+TLS handshake each time
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                loop=self.loop,
+                limit=int(os.getenv("HTTP_MAX_CONNECTIONS", 256)),
+                limit_per_host=int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", self.FETCH_CONCURRENCY + 2)),
+                ttl_dns_cache=int(os.getenv("HTTP_DNS_CACHE_TTL", 300)),
+                keepalive_timeout=int(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 60)),
+            )
+            self.session = aiohttp.ClientSession(
+                loop=self.loop,
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=int(os.getenv("HTTP_TIMEOUT", 60)),
+                    sock_connect=int(os.getenv("HTTP_CONNECT_TIMEOUT", 10)),
+                ),
+            )
+        return self.session
+
+    def _log_url(self, operator_information, endpoint):
+        # Log lists only carry the host and path, but a full URL is handy for pointing at a local log
+        if '://' in operator_information['url']:
+            return "{}/ct/v1/{}".format(operator_information['url'], endpoint)
+        return "https://{}/ct/v1/{}".format(operator_information['url'], endpoint)
 
     async def _print_memory_usage(self):
         import objgraph
         import gc
 
         while True:
-            print("Stream backlog : {}".format(self.stream.qsize()))
+            print("Stream backlog : {} ({} bytes)".format(self.stream.qsize(), self.stream.size_bytes))
             gc.collect()
             objgraph.show_growth()
             await asyncio.sleep(60)
 
     def get_tasks(self):
-        self._initialize_ts_logs()
+        self.pipeline.start()
 
-        coroutines = []
+        coroutines = [self.watch_log_list_task()]
 
         if os.getenv("DEBUG_MEMORY", False):
             coroutines.append(self._print_memory_usage())
 
-        for log in self.transparency_logs['logs']:
-            if log['url'] not in self.BAD_CT_SERVERS:
-                coroutines.append(self.watch_for_updates_task(log))
+        if self.checkpoints.enabled:
+            coroutines.append(self.checkpoints.flush_task())
+
+        if self.dedup.mode == 'merge':
+            coroutines.append(self.dedup.merge_task(self.stream))
+
         return coroutines
 
+    def done(self, record):
+        """
+        Called by whatever broadcasts the stream once record has gone out.
+        """
+        self.checkpoints.done(record.log_url, record.cert_index)
+
     def stop(self):
         self.logger.info('Got stop order, exiting...')
         self.stopped = True
+        self.pipeline.stop()
+        self.checkpoints.flush()
         for task in asyncio.Task.all_tasks():
             task.cancel()
+        if self.session is not None:
+            asyncio.ensure_future(self.session.close(), loop=self.loop)
 
     async def watch_for_updates_task(self, operator_information):
         try:
-            latest_size = 0
+            latest_size = None
             name = operator_information['description']
+
+            log_url = operator_information['url']
+            log_metrics = self.log_metrics[log_url] = LogMetrics(*(
+                metric.labels(log_url) for metric in (
+                    metrics.STH_LATENCY, metrics.TREE_LAG, metrics.GET_ENTRIES_LATENCY, metrics.ENTRIES_FETCHED, metrics.LOG_ERRORS
+                )
+            ))
+
+            schedule = self.scheduler.add(operator_information)
+
             while not self.stopped:
+                await schedule.wait()
+
                 try:
-                    async with aiohttp.ClientSession(loop=self.loop) as session:
-                        async with session.get("https://{}/ct/v1/get-sth".format(operator_information['url'])) as response:
+                    async with self.scheduler.request_slots:
+                        started = time.monotonic()
+                        async with self._get_session().get(self._log_url(operator_information, "get-sth")) as response:
+                            response.raise_for_status()
                             info = await response.json()
-                except aiohttp.ClientError as e:
-                    self.logger.info('[{}] Exception -> {}'.format(name, e))
-                    await asyncio.sleep(600)
+                        log_metrics.sth_latency.observe(time.monotonic() - started)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    self._record_failure(name, schedule, log_metrics, e)
                     continue
 
                 tree_size = info.get('tree_size')
+                if schedule.record_sth(tree_size, info.get('timestamp')):
+                    self.logger.warning('[{}] Log is answering again, back to polling it normally'.format(name))
 
-                # TODO: Add in persistence and id tracking per log
-                if latest_size == 0:
-                    latest_size = tree_size
+                if latest_size is None:
+                    latest_size = self._resume_position(operator_information, tree_size)
+                    self.checkpoints.set(operator_information['url'], latest_size)
+
+                log_metrics.tree_lag.set(tree_size - latest_size)
 
                 if latest_size < tree_size:
                     self.logger.info('[{}] [{} -> {}] New certs found, updating!'.format(name, latest_size, tree_size))
 
                     try:
+                        # Parsed batches come back from the pipeline as futures, we await them in submission
+                        # order so entries still hit the stream in index order
+                        pending = collections.deque()
                         async for result_chunk in self.get_new_results(operator_information, latest_size, tree_size):
-                            for entry in result_chunk:
-                                cert_data = parse_ctl_entry(entry, operator_information)
-                                await self.stream.put(cert_data)
+                            pending.append(await self.pipeline.submit(result_chunk, operator_information))
+
+                            while pending and (pending[0].done() or len(pending) > self.pipeline.max_in_flight):
+                                latest_size = await self._emit_parsed(operator_information, await pending.popleft(), latest_size)
+                                log_metrics.tree_lag.set(tree_size - latest_size)
+
+                        while pending:
+                            latest_size = await self._emit_parsed(operator_information, await pending.popleft(), latest_size)
+                            log_metrics.tree_lag.set(tree_size - latest_size)
 
-                    except aiohttp.ClientError as e:
-                        self.logger.info('[{}] Exception -> {}'.format(name, e))
-                        await asyncio.sleep(600)
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        self._record_failure(name, schedule, log_metrics, e)
                         continue
 
+                    except asyncio.CancelledError:
+                        raise
+
                     except Exception as e:
                         print("Encountered an exception while getting new results! -> {}".format(e))
                         return
-
-                    latest_size = tree_size
                 else:
                     self.logger.debug('[{}][{}|{}] No update needed, continuing...'.format(name, latest_size, tree_size))
-
-                await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             print("Encountered an exception while getting new results! -> {}".format(e))
             return
 
-    async def get_new_results(self, operator_information, latest_size, tree_size):
-        # The top of the tree isn't actually a cert yet, so the total_size is what we're aiming for
-        total_size = tree_size - latest_size
-        start = latest_size
+    def _record_failure(self, name, schedule, log_metrics, error):
+        log_metrics.errors.inc()
+        if schedule.record_failure():
+            self.logger.warning('[{}] {} failures in a row, demoting the log to a retry every {:.0f}s -> {}'.format(
+                name, schedule.failures, self.scheduler.demoted_interval, error
+            ))
+        else:
+            self.logger.info('[{}] Exception -> {}, retrying in {:.0f}s'.format(name, error, schedule.interval))
+
+    def _resume_position(self, operator_information, tree_size):
+        checkpoint = self.checkpoints.get(operator_information['url'])
+
+        if checkpoint is None:
+            return tree_size
+
+        if tree_size - checkpoint > self.MAX_CATCHUP:
+            self.logger.warning('[{}] Checkpoint {} is {} entries behind, only catching up on the last {}'.format(
+                operator_information['description'], checkpoint, tree_size - checkpoint, self.MAX_CATCHUP
+            ))
+            return tree_size - self.MAX_CATCHUP
+
+        self.logger.info('[{}] Resuming from checkpoint {}'.format(operator_information['description'], checkpoint))
+
+        return min(checkpoint, tree_size)
+
+    async def _emit_parsed(self, operator_information, records, latest_size):
+        # Returns the next index we need from the log, so a failure part way through resumes where we stopped
+        log_url = operator_information['url']
+        for record in records:
+            latest_size = record.cert_index + 1
+
+            # The checkpoint only moves past it once it's been broadcast, see done()
+            self.checkpoints.hand_off(log_url, record.cert_index)
+            if self.dedup.enabled:
+                filtered = self.dedup.filter(record)
+                if filtered is None:
+                    if not self.dedup.holding(record):
+                        self.checkpoints.done(log_url, record.cert_index)
+                    continue
+            if record.trace is not None:
+                record.trace['enqueued'] = time.monotonic()
+            await self.stream.put(record)
 
-        end = start + self.MAX_BLOCK_SIZE
+        # Only touches memory, the store writes itself out in batches
+        self.checkpoints.set(log_url, latest_size)
 
-        chunks = math.ceil(total_size / self.MAX_BLOCK_SIZE)
+        return latest_size
 
-        self.logger.info("Retrieving {} certificates ({} -> {}) for {}".format(tree_size-latest_size, latest_size, tree_size, operator_information['description']))
-        async with aiohttp.ClientSession(loop=self.loop) as session:
-            for _ in range(chunks):
-                # Cap the end to the last record in the DB
-                if end >= tree_size:
-                    end = tree_size - 1
+    async def _fetch_entries(self, session, operator_information, start, end):
+        url = self._log_url(operator_information, "get-entries?start={}&end={}".format(start, end))
+        log_metrics = self.log_metrics.get(operator_information['url'])
 
-                assert end >= start, "End {} is less than start {}!".format(end, start)
-                assert end < tree_size, "End {} is less than tree_size {}".format(end, tree_size)
+        async with self.scheduler.request_slots:
+            started = time.monotonic()
+            async with session.get(url) as response:
+                response.raise_for_status()
+                certificates = await response.json()
 
-                url = "https://{}/ct/v1/get-entries?start={}&end={}".format(operator_information['url'], start, end)
+        if 'entries' not in certificates:
+            raise aiohttp.ClientError("Bad get-entries response for {}-{} -> {}".format(start, end, certificates.get('error_message')))
 
-                async with session.get(url) as response:
-                    certificates = await response.json()
-                    if 'error_message' in certificates:
-                        print("error!")
+        fetch_seconds = time.monotonic() - started
+        if log_metrics is not None:
+            log_metrics.get_entries_latency.observe(fetch_seconds)
+            log_metrics.entries_fetched.inc(len(certificates['entries']))
 
-                    for index, cert in zip(range(start, end+1), certificates['entries']):
-                        cert['index'] = index
+        TRACER.sample(certificates['entries'], operator_information['url'], start, fetch_seconds)
 
-                    yield certificates['entries']
+        return certificates['entries']
 
-                start += self.MAX_BLOCK_SIZE
+    async def get_new_results(self, operator_information, latest_size, tree_size):
+        """
+        Yield chunks of entries from latest_size up to (but not including) tree_size, in index order.
+
+        Up to FETCH_CONCURRENCY get-entries requests are kept in flight. Logs are free to return fewer
+        entries than asked for, so a short response gets the remainder re-requested ahead of everything
+        else and the page size the log returned is remembered for subsequent requests (see BlockSizes).
+        """
+        log_url = operator_information['url']
+
+        self.logger.info("Retrieving {} certificates ({} -> {}) for {}".format(tree_size-latest_size, latest_size, tree_size, operator_information['description']))
 
-                end = start + self.MAX_BLOCK_SIZE + 1
+        pending = collections.deque()
+        next_start = latest_size
+
+        session = self._get_session()
+
+        def request(start, end):
+            return start, end, asyncio.ensure_future(self._fetch_entries(session, operator_information, start, end))
+
+        try:
+            while pending or next_start < tree_size:
+                while len(pending) < self.FETCH_CONCURRENCY and next_start < tree_size:
+                    # The top of the tree isn't actually a cert yet, so we stop one short of tree_size
+                    end = min(next_start + self.block_sizes.get(log_url), tree_size) - 1
+                    pending.append(request(next_start, end))
+                    next_start = end + 1
+
+                start, end, task = pending.popleft()
+                entries = (await task)[:end - start + 1]
+
+                if not entries:
+                    raise aiohttp.ClientError("Log returned no entries for {}-{}".format(start, end))
+
+                self.block_sizes.record(log_url, end - start + 1, len(entries), tail=end >= tree_size - 1)
+                if start + len(entries) <= end:
+                    pending.appendleft(request(start + len(entries), end))
+
+                for index, cert in enumerate(entries, start):
+                    cert['index'] = index
+
+                yield entries
+        finally:
+            for _, _, task in pending:
+                task.cancel()
 
 class DummyTransparencyWatcher(object):
     stream = asyncio.Queue()
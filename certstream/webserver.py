@@ -1,8 +1,10 @@
 import asyncio
 import collections
+import hmac
 import json
 import logging
 import os
+import threading
 import time
 import ssl
 
@@ -10,11 +12,29 @@ from aiohttp import web
 from aiohttp.web_urldispatcher import Response
 from aiohttp.web_ws import WebSocketResponse
 
-from certstream.util import pretty_date, get_ip
+from certstream import metrics
+from certstream.archive import CertificateArchive
+from certstream.backfill import Backfiller, ChannelSink
+from certstream.clientqueue import ClientQueue
+from certstream.filters import SubscriptionIndex
+from certstream.httpcache import CachedJsonResponse
+from certstream.messages import CertificateMessage, EncodedCertificate, STREAM_TYPES
+from certstream.replay import ReplayBuffer
+from certstream.tracing import TRACER, StackSampler, lap
+from certstream.util import pretty_date, get_ip, get_rss
+
+BATCH_FORMATS = {
+    'array': lambda frames: '[' + ','.join(frames) + ']',
+    'ndjson': '\n'.join,
+}
+
+# Largest batches a client can ask for, so nobody gets to hold a client queue's worth of frames for minutes
+BATCH_MAX_MESSAGES = int(os.getenv("BATCH_MAX_MESSAGES", 1000))
+BATCH_MAX_MS = float(os.getenv("BATCH_MAX_MS", 5000))
 
 WebsocketClientInfo = collections.namedtuple(
     'WebsocketClientInfo',
-    ['external_ip', 'queue', 'connection_time']
+    ['external_ip', 'queue', 'connection_time', 'domain_filters', 'stream_type']
 )
 
 STATIC_INDEX = '''
@@ -32,23 +52,72 @@ STATIC_INDEX = '''
 '''.format(time.time())
 
 class WebServer(object):
-    def __init__(self, _loop, transparency_watcher):
+    # Records fanned out between giving the client senders a turn, comfortably under CLIENT_QUEUE_SIZE
+    FANOUT_YIELD_EVERY = 64
+
+    def __init__(self, _loop, transparency_watcher, worker_stats=None, worker_id=None):
         self.active_sockets = []
-        self.recently_seen = collections.deque(maxlen=25)
+        self.recently_seen = collections.deque(maxlen=int(os.getenv("LATEST_JSON_SIZE", 25)))
+        self.subscriptions = SubscriptionIndex()
+        self.replay_buffer = ReplayBuffer()
+        self.last_seq = 0
+
+        # Only one process gets to write the archive, any other websocket workers search it read only
+        self.archive = CertificateArchive(read_only=bool(worker_id))
+        self.search_max_results = int(os.getenv("ARCHIVE_MAX_RESULTS", 1000))
+
+        # Rebuilt at most once per new certificate however often they're polled, by splicing together the
+        # full frames rather than decoding and encoding them again
+        self.latest_json = CachedJsonResponse(
+            lambda: '{{"messages": [{}]}}'.format(', '.join(message.frame() for message in self.recently_seen))
+        )
+        self.example_json = CachedJsonResponse(lambda: self.recently_seen[0].frame() if self.recently_seen else '{}')
+
         self.stats_url = os.getenv("STATS_URL", 'stats')
+        self.search_url = os.getenv("SEARCH_URL", 'search')
+        self.metrics_url = os.getenv("METRICS_URL", 'metrics')
         self.logger = logging.getLogger('certstream.webserver')
 
         self.loop = _loop
         self.watcher = transparency_watcher
 
+        # Admin routes only exist when there's a token to protect them with
+        self.admin_token = os.getenv("ADMIN_TOKEN")
+
+        # Backfills need a watcher that polls the logs itself, so they aren't available on edge nodes or
+        # websocket workers
+        self.backfiller = Backfiller(self.watcher) if hasattr(self.watcher, 'pipeline') else None
+        self.backfill_sockets = []
+
+        # Only one profile at a time, a second sampler would just double the overhead
+        self.profiler = None
+        self.max_profile_seconds = float(os.getenv("PROFILE_MAX_SECONDS", 300))
+
+        # Only set when we're one of several websocket workers sharing a port
+        self.worker_stats = worker_stats
+        self.worker_id = worker_id
+
         self.app = web.Application(loop=self.loop)
 
         self._add_routes()
-
-    def run_server(self):
+        self.app.on_shutdown.append(self._flush_checkpoints)
+        self.app.on_cleanup.append(self._close_archive)
+
+        metrics.CONNECTED_CLIENTS.set_function(lambda: len(self.active_sockets))
+        metrics.CLIENT_QUEUED_FRAMES.set_function(lambda: sum(client.queue.qsize() for client in self.active_sockets))
+        metrics.CLIENT_QUEUED_BYTES.set_function(lambda: sum(client.queue.size_bytes for client in self.active_sockets))
+        metrics.CLIENT_MAX_QUEUE_DEPTH.set_function(lambda: max((client.queue.qsize() for client in self.active_sockets), default=0))
+        metrics.CLIENT_MAX_LAG.set_function(lambda: max((client.queue.lag() for client in self.active_sockets), default=0))
+        metrics.REPLAY_BUFFER_BYTES.set_function(lambda: self.replay_buffer.size_bytes)
+        metrics.ARCHIVE_BYTES.set_function(lambda: self.archive.size_bytes)
+
+    def run_server(self, reuse_port=False):
         self.mux_stream = asyncio.ensure_future(self.mux_ctl_stream())
         self.heartbeat_coro = asyncio.ensure_future(self.ws_heartbeats())
 
+        if self.worker_stats is not None:
+            self.worker_stats_coro = asyncio.ensure_future(self.report_worker_stats())
+
         if os.environ.get("NOSSL", False):
             ssl_ctx = None
         else:
@@ -58,33 +127,111 @@ class WebServer(object):
         web.run_app(
             self.app,
             port=int(os.environ.get('PORT', 8080)),
-            ssl_context=ssl_ctx
+            ssl_context=ssl_ctx,
+            reuse_port=reuse_port
         )
 
+    async def _flush_checkpoints(self, app):
+        # So a restart carries on from what was actually broadcast rather than the last periodic flush
+        checkpoints = getattr(self.watcher, 'checkpoints', None)
+        if checkpoints is not None:
+            checkpoints.flush()
+
+    async def _close_archive(self, app):
+        # Waits on the writer thread to finish what's queued
+        await self.loop.run_in_executor(None, self.archive.close)
+
     def _add_routes(self):
         self.app.router.add_get("/latest.json", self.latest_json_handler)
         self.app.router.add_get("/example.json", self.example_json_handler)
         self.app.router.add_get("/{}".format(self.stats_url), self.stats_handler)
+        self.app.router.add_get("/{}".format(self.metrics_url), metrics.metrics_handler)
+        if self.archive.enabled:
+            self.app.router.add_get("/{}".format(self.search_url), self.search_handler)
+        if self.backfiller is not None:
+            self.app.router.add_get('/backfill', self.backfill_channel_handler)
+        if self.admin_token:
+            self.app.router.add_post('/admin/backfill', self.backfill_start_handler)
+            self.app.router.add_get('/admin/backfill', self.backfill_list_handler)
+            self.app.router.add_delete('/admin/backfill/{id}', self.backfill_cancel_handler)
+            self.app.router.add_get('/admin/traces', self.traces_handler)
+            self.app.router.add_get('/admin/profile', self.profile_handler)
         self.app.router.add_get('/', self.root_handler)
+        self.app.router.add_get('/lite', self.lite_handler)
+        self.app.router.add_get('/domains-only', self.domains_only_handler)
         self.app.router.add_get('/develop', self.dev_handler)
 
     async def mux_ctl_stream(self):
+        trace = None
+        fanned_out = 0
         while True:
-            cert_data = await self.watcher.stream.get()
+            item = await self.watcher.stream.get()
+
+            # A get from a queue that has items doesn't yield, so while the watcher hands over whole pages
+            # we'd fill every client's queue before a single sender got to run. Let them drain now and then.
+            fanned_out += 1
+            if fanned_out % self.FANOUT_YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+
+            if isinstance(item, CertificateMessage):
+                # Already sequenced and encoded by an ingest node
+                message = item
+                if message.seq <= self.last_seq:
+                    # Only if the ingest node's clock went backwards across a restart. Replays rely on
+                    # sequence numbers only ever going up, so whatever we had can't be replayed any more.
+                    self.logger.warning("Sequence number went back from {} to {}, clearing the replay buffer".format(self.last_seq, message.seq))
+                    self.replay_buffer.clear()
+                self.last_seq = message.seq
+            else:
+                self.last_seq += 1
+
+                # Encode once per stream type and hand the same immutable frame to every client, so per-client
+                # cost is just the send
+                if isinstance(item, EncodedCertificate):
+                    trace = item.trace
+                    if trace is not None:
+                        trace['spans']['stream_queue_wait'] = time.monotonic() - trace['enqueued']
+                        started = time.perf_counter()
+                    message = CertificateMessage.from_encoded(self.last_seq, item.data_json, item.seen, item.all_domains)
+                    if trace is not None:
+                        started = lap(trace['spans'], 'frame_encode', started)
+                else:
+                    message = CertificateMessage({
+                        "message_type": "certificate_update",
+                        "seq": self.last_seq,
+                        "data": item
+                    })
+
+            # Match the certificate once against every client's filters rather than once per client
+            matched = self.subscriptions.match(message.all_domains) if self.subscriptions else ()
 
-            data_packet = {
-                "message_type": "certificate_update",
-                "data": cert_data
-            }
+            for client in self.active_sockets:
+                if client.domain_filters is not None and client not in matched:
+                    continue
 
-            self.recently_seen.append(data_packet)
+                client.queue.put_nowait(message.frame(client.stream_type))
 
-            for client in self.active_sockets:
-                try:
-                    client.queue.put_nowait(data_packet)
-                except asyncio.QueueFull:
-                    pass
+            if isinstance(item, EncodedCertificate):
+                # Now it's gone out the watcher's checkpoint can move past it
+                self.watcher.done(item)
+
+            if trace is not None:
+                lap(trace['spans'], 'fanout', started)
+                trace['clients'] = len(self.active_sockets)
+                TRACER.record(trace)
+                trace = None
 
+            if message.seen is not None:
+                metrics.BROADCAST_LATENCY.observe(time.time() - message.seen)
+
+            # From here on the message is only kept around for replays, so it's cut down to its full frame
+            message.compact()
+            self.recently_seen.append(message)
+            self.replay_buffer.append(message)
+            self.archive.append(message)
+
+            self.latest_json.invalidate()
+            self.example_json.invalidate()
 
     async def dev_handler(self, request):
         # If we have a websocket request
@@ -94,9 +241,8 @@ class WebServer(object):
             await ws.prepare(request)
 
             try:
-                for message in self.recently_seen:
-                    message_json = json.dumps(message)
-                    await ws.send_str(message_json)
+                for message in list(self.recently_seen):
+                    await ws.send_str(message.frame())
             except asyncio.CancelledError:
                 print('websocket cancelled')
 
@@ -114,59 +260,352 @@ class WebServer(object):
             content_type="application/json",
         )
 
-    async def root_handler(self, request):
+    async def lite_handler(self, request):
+        return await self.root_handler(request, stream_type='lite')
+
+    async def domains_only_handler(self, request):
+        return await self.root_handler(request, stream_type='domains-only')
+
+    async def root_handler(self, request, stream_type=None):
         resp = WebSocketResponse()
         available = resp.can_prepare(request)
         if not available:
             return Response(body=STATIC_INDEX, content_type="text/html")
 
-        await resp.prepare(request)
+        if stream_type is None:
+            stream_type = request.query.get('stream', 'full')
+
+        if stream_type not in STREAM_TYPES:
+            return web.Response(
+                body=json.dumps({"error": "Unknown stream type, expected one of {}".format(", ".join(STREAM_TYPES))}, indent=4),
+                content_type="application/json",
+                status=400,
+            )
 
-        client_queue = asyncio.Queue(maxsize=500)
+        batch_size = None
+        if 'batch' in request.query:
+            try:
+                batch_size = int(request.query['batch'])
+                batch_ms = float(request.query.get('batch_ms', 50))
+                batch_format = BATCH_FORMATS[request.query.get('batch_format', 'array')]
+                if not 1 <= batch_size <= BATCH_MAX_MESSAGES or not 0 <= batch_ms <= BATCH_MAX_MS:
+                    raise ValueError
+                batch_delay = batch_ms / 1000
+            except (KeyError, ValueError):
+                return web.Response(
+                    body=json.dumps({
+                        "error": "batch must be a count from 1 to {}, batch_ms a delay of at most {} milliseconds and batch_format one of {}".format(
+                            BATCH_MAX_MESSAGES, BATCH_MAX_MS, ", ".join(BATCH_FORMATS)
+                        )
+                    }, indent=4),
+                    content_type="application/json",
+                    status=400,
+                )
+
+        since = None
+        if 'since' in request.query:
+            try:
+                since = int(request.query['since'])
+            except ValueError:
+                return web.Response(
+                    body=json.dumps({"error": "since must be a sequence number"}, indent=4),
+                    content_type="application/json",
+                    status=400,
+                )
+
+        domain_filters = None
+        if 'domains' in request.query:
+            domain_filters = tuple(
+                pattern for value in request.query.getall('domains') for pattern in value.split(',') if pattern.strip()
+            ) or None
+
+        # Stuck clients get dealt with by their own queue policy and can never hold up the broadcast loop.
+        # A client that has to be disconnected is almost certainly not reading, so its pending writes would
+        # never drain and the transport has to be aborted rather than closed.
+        def abort_connection():
+            if request.transport is not None:
+                request.transport.abort()
+
+        try:
+            client_queue = ClientQueue(
+                policy=request.query.get('policy'),
+                max_size=ClientQueue.limit('max_queue', int(request.query['max_queue']), ClientQueue.MAX_SIZE) if 'max_queue' in request.query else None,
+                max_bytes=ClientQueue.limit('max_bytes', int(request.query['max_bytes']), ClientQueue.MAX_BYTES) if 'max_bytes' in request.query else None,
+                max_lag=ClientQueue.limit('max_lag', float(request.query['max_lag']), ClientQueue.MAX_LAG) if 'max_lag' in request.query else None,
+                on_overflow=abort_connection,
+            )
+        except ValueError as e:
+            return web.Response(
+                body=json.dumps({"error": "Invalid queue settings -> {}".format(e)}, indent=4),
+                content_type="application/json",
+                status=400,
+            )
 
         client = WebsocketClientInfo(
             external_ip=get_ip(request),
             queue=client_queue,
             connection_time=int(time.time()),
+            domain_filters=domain_filters,
+            stream_type=stream_type,
         )
 
+        if domain_filters is not None:
+            try:
+                self.subscriptions.add(client, domain_filters)
+            except ValueError as e:
+                return web.Response(
+                    body=json.dumps({"error": "Invalid domain filter -> {}".format(e)}, indent=4),
+                    content_type="application/json",
+                    status=400,
+                )
+
         try:
+            await resp.prepare(request)
+
             self.logger.info('Client {} joined.'.format(client.external_ip))
+
+            if since is not None:
+                await self._replay(resp, client, since)
+
+            # There's no await between the replay catching up and joining the live stream, so nothing can
+            # slip through the gap
             self.active_sockets.append(client)
-            while True:
-                message = await client_queue.get()
-                message_json = json.dumps(message)
-                await resp.send_str(message_json)
+
+            if batch_size is None:
+                while True:
+                    frame = await client_queue.get()
+                    if TRACER.sampled():
+                        started = time.perf_counter()
+                        await resp.send_str(frame)
+                        TRACER.record_send(time.perf_counter() - started, client.stream_type)
+                    else:
+                        await resp.send_str(frame)
+            else:
+                # Coalesce already encoded frames into one websocket frame, trading a few ms of latency for
+                # far fewer frames, writes and compression passes
+                while True:
+                    frames = await client_queue.get_batch(batch_size, batch_delay)
+                    if TRACER.sampled():
+                        started = time.perf_counter()
+                        await resp.send_str(batch_format(frames))
+                        TRACER.record_send(time.perf_counter() - started, client.stream_type, frames=len(frames))
+                    else:
+                        await resp.send_str(batch_format(frames))
+
+        except ConnectionResetError:
+            if not client_queue.overflowed:
+                raise
+            self.logger.info('Client {} fell too far behind, disconnecting.'.format(client.external_ip))
 
         finally:
-            self.active_sockets.remove(client)
+            if client in self.active_sockets:
+                self.active_sockets.remove(client)
+            self.subscriptions.remove(client)
             self.logger.info('Client {} disconnected.'.format(client.external_ip))
 
-    async def latest_json_handler(self, _):
+        return resp
+
+    async def _replay(self, resp, client, since):
+        replay_filter = None
+        if client.domain_filters is not None:
+            replay_filter = SubscriptionIndex()
+            replay_filter.add(client, client.domain_filters)
+
+        last_seq = since
+        while True:
+            messages = self.replay_buffer.since(last_seq)
+            if not messages:
+                if last_seq != self.last_seq:
+                    # Either the buffer is disabled or the sequence number is from the future, most likely
+                    # from before a restart. Queued rather than sent, as awaiting a send here would let
+                    # certificates be broadcast before the client has joined the live stream.
+                    client.queue.put_nowait(self._replay_gap(since, self.replay_buffer.first_seq))
+                return
+
+            for message in messages:
+                if message.seq > last_seq + 1:
+                    await resp.send_str(self._replay_gap(last_seq, message.seq))
+                if replay_filter is None or replay_filter.match(message.all_domains):
+                    await resp.send_str(message.frame(client.stream_type))
+                last_seq = message.seq
+
+    def _replay_gap(self, requested_seq, oldest_seq):
+        return json.dumps({
+            "message_type": "replay_gap",
+            "requested_seq": requested_seq,
+            "oldest_available_seq": oldest_seq
+        })
+
+    async def latest_json_handler(self, request):
+        return self.latest_json.response(request)
+
+    async def example_json_handler(self, request):
+        return self.example_json.response(request)
+
+    async def search_handler(self, request):
+        try:
+            pattern = request.query['domain']
+            hours = float(request.query.get('hours', 24))
+            limit = min(int(request.query.get('limit', 100)), self.search_max_results)
+            if hours <= 0 or limit < 1:
+                raise ValueError
+        except (KeyError, ValueError):
+            return web.Response(
+                body=json.dumps({
+                    "error": "domain is required, hours must be a positive number of hours and limit a positive count"
+                }, indent=4),
+                content_type="application/json",
+                status=400,
+            )
+
+        started = time.monotonic()
+        try:
+            # Reading and decompressing up to ARCHIVE_MAX_RESULTS frames is disk work, kept off the loop
+            frames = await self.loop.run_in_executor(None, self.archive.search, pattern, time.time() - hours * 3600, limit)
+        except ValueError as e:
+            return web.Response(
+                body=json.dumps({"error": "Invalid domain pattern -> {}".format(e)}, indent=4),
+                content_type="application/json",
+                status=400,
+            )
+        metrics.ARCHIVE_SEARCH_SECONDS.observe(time.monotonic() - started)
+
+        # The archived frames are already JSON, so they're spliced in rather than decoded and encoded again
         return web.Response(
-            body=json.dumps(
-                {
-                    "messages": list(self.recently_seen)
-                },
-                indent=4
+            body='{{"domain": {}, "hours": {}, "count": {}, "messages": [{}]}}'.format(
+                json.dumps(pattern), json.dumps(hours), len(frames), ', '.join(frames)
             ),
             headers={"Access-Control-Allow-Origin": "*"},
             content_type="application/json",
         )
 
-    async def example_json_handler(self, _):
-        if self.recently_seen:
-            return web.Response(
-                body=json.dumps(list(self.recently_seen)[0], indent=4),
-                headers={"Access-Control-Allow-Origin": "*"},
-                content_type="application/json",
-            )
+    def _is_admin(self, request):
+        token = request.headers.get('Authorization', '')
+        if token.startswith('Bearer '):
+            token = token[len('Bearer '):]
         else:
-            return web.Response(
-                body="{}",
-                headers={"Access-Control-Allow-Origin": "*"},
-                content_type="application/json"
+            token = request.query.get('token', '')
+        return hmac.compare_digest(token.encode('utf-8'), self.admin_token.encode('utf-8'))
+
+    def _admin_error(self, error, status):
+        return web.Response(body=json.dumps({"error": error}, indent=4), content_type="application/json", status=status)
+
+    async def backfill_start_handler(self, request):
+        if not self._is_admin(request):
+            return self._admin_error("Missing or wrong admin token", 401)
+
+        if self.backfiller is None:
+            return self._admin_error("Backfills can only be run by a process that polls the logs itself", 400)
+
+        try:
+            output = request.query.get('output', 'file')
+            if output not in ('file', 'stream'):
+                raise ValueError("output must be file or stream")
+            if output == 'stream' and not self.backfill_sockets:
+                # It would only sit there paused until someone subscribed
+                return self._admin_error("Nobody is subscribed to the backfill channel", 409)
+            job = self.backfiller.start(
+                request.query['log'],
+                int(request.query['start']),
+                int(request.query['end']),
+                sink=ChannelSink(self.backfill_sockets) if output == 'stream' else None,
+                concurrency=int(request.query['concurrency']) if 'concurrency' in request.query else None,
             )
+        except KeyError as e:
+            return self._admin_error("Missing {}, log, start and end are required".format(e), 400)
+        except (ValueError, OSError) as e:
+            return self._admin_error("Unable to start backfill -> {}".format(e), 400)
+
+        return web.Response(body=json.dumps(job.progress(), indent=4), content_type="application/json", status=202)
+
+    async def backfill_list_handler(self, request):
+        if not self._is_admin(request):
+            return self._admin_error("Missing or wrong admin token", 401)
+
+        jobs = self.backfiller.stats() if self.backfiller is not None else []
+        return web.Response(body=json.dumps({"jobs": jobs}, indent=4), content_type="application/json")
+
+    async def backfill_cancel_handler(self, request):
+        if not self._is_admin(request):
+            return self._admin_error("Missing or wrong admin token", 401)
+
+        if self.backfiller is None or not self.backfiller.cancel(request.match_info['id']):
+            return self._admin_error("No backfill {}".format(request.match_info['id']), 404)
+
+        return web.Response(body=json.dumps({"cancelled": request.match_info['id']}, indent=4), content_type="application/json")
+
+    async def traces_handler(self, request):
+        if not self._is_admin(request):
+            return self._admin_error("Missing or wrong admin token", 401)
+
+        try:
+            limit = int(request.query.get('limit', 100))
+        except ValueError:
+            return self._admin_error("limit must be a count of traces", 400)
+
+        return web.Response(
+            body=json.dumps({"sample_rate": TRACER.sample_rate, "traces": TRACER.recent(limit)}, indent=4),
+            content_type="application/json",
+        )
+
+    async def profile_handler(self, request):
+        if not self._is_admin(request):
+            return self._admin_error("Missing or wrong admin token", 401)
+
+        try:
+            seconds = float(request.query.get('seconds', 10))
+            interval = float(request.query.get('interval', 0.005))
+            if not 0 < seconds <= self.max_profile_seconds or interval <= 0:
+                raise ValueError
+        except ValueError:
+            return self._admin_error(
+                "seconds must be a number of seconds up to {} and interval a positive number of seconds".format(self.max_profile_seconds),
+                400
+            )
+
+        if self.profiler is not None:
+            return self._admin_error("A profile is already running", 409)
+
+        # We're on the event loop's thread here, which is the one we want to watch
+        self.profiler = StackSampler(interval=interval, thread_id=threading.get_ident())
+        self.logger.info("Profiling the event loop for {} seconds".format(seconds))
+        self.profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.profiler.stop()
+            profiler, self.profiler = self.profiler, None
+
+        self.logger.info("Profile finished with {} samples".format(profiler.samples))
+        return web.Response(text=profiler.collapsed(), content_type="text/plain")
+
+    async def backfill_channel_handler(self, request):
+        resp = WebSocketResponse()
+        if not resp.can_prepare(request):
+            return Response(body=STATIC_INDEX, content_type="text/html")
+
+        # Backfills wait on their slowest subscriber, so nothing is normally dropped here
+        client = WebsocketClientInfo(
+            external_ip=get_ip(request),
+            queue=ClientQueue(),
+            connection_time=int(time.time()),
+            domain_filters=None,
+            stream_type='full',
+        )
+
+        await resp.prepare(request)
+        self.backfill_sockets.append(client)
+        self.logger.info('Client {} joined the backfill channel.'.format(client.external_ip))
+
+        try:
+            while True:
+                frame = await client.queue.get()
+                await resp.send_str(frame)
+        finally:
+            self.backfill_sockets.remove(client)
+            self.logger.info('Client {} left the backfill channel.'.format(client.external_ip))
+
+        return resp
 
     async def stats_handler(self, _):
         clients = {}
@@ -177,28 +616,79 @@ class WebServer(object):
                 "conection_time": client.connection_time,
                 "connection_length": pretty_date(client.connection_time),
                 "queue_size": client.queue.qsize(),
+                "queue_bytes": client.queue.size_bytes,
+                "queue_policy": client.queue.policy,
+                "lag_seconds": client.queue.lag(),
+                "dropped": client.queue.dropped,
+                "domain_filters": client.domain_filters,
+                "stream_type": client.stream_type,
             }
 
+        stats = {
+            "connected_client_count": len(self.active_sockets),
+            "clients": clients
+        }
+
+        stats["memory"] = {
+            "rss_bytes": get_rss(),
+            "stream_queue_bytes": getattr(self.watcher.stream, 'size_bytes', None),
+            "replay_buffer_bytes": self.replay_buffer.size_bytes,
+            "client_queue_bytes": sum(client.queue.size_bytes for client in self.active_sockets),
+        }
+
+        if self.archive.enabled:
+            stats["archive"] = self.archive.stats()
+
+        pipeline = getattr(self.watcher, 'pipeline', None)
+        if pipeline is not None:
+            stats["chain_cache"] = pipeline.chain_cache_stats()
+
+        if self.backfiller is not None and self.backfiller.jobs:
+            stats["backfills"] = self.backfiller.stats()
+
+        dedup = getattr(self.watcher, 'dedup', None)
+        if dedup is not None and dedup.enabled:
+            stats["dedup"] = dedup.stats()
+
+        scheduler = getattr(self.watcher, 'scheduler', None)
+        if scheduler is not None:
+            stats["logs"] = scheduler.stats()
+
+        if self.worker_stats is not None:
+            # The client list above only covers the worker that answered, these cover all of them
+            workers = self.worker_stats.snapshot()
+            stats["worker_id"] = self.worker_id
+            stats["workers"] = workers
+            stats["total_connected_client_count"] = sum(worker['connected_client_count'] for worker in workers)
+            stats["total_queued_messages"] = sum(worker['queued_messages'] for worker in workers)
+
         return web.Response(
-            body=json.dumps({
-                    "connected_client_count": len(self.active_sockets),
-                    "clients": clients
-                }, indent=4
-            ),
+            body=json.dumps(stats, indent=4),
             content_type="application/json",
         )
 
+    async def report_worker_stats(self):
+        while True:
+            self.worker_stats.update(
+                self.worker_id,
+                connected_client_count=len(self.active_sockets),
+                queued_messages=sum(client.queue.qsize() for client in self.active_sockets),
+                queued_bytes=sum(client.queue.size_bytes for client in self.active_sockets),
+            )
+            await asyncio.sleep(1)
+
     async def ws_heartbeats(self):
         self.logger.info("Starting WS heartbeat coro...")
         while True:
             await asyncio.sleep(30)
             self.logger.debug("Sending ping...")
-            timestamp = time.time()
+            frame = json.dumps({
+                "message_type": "heartbeat",
+                "timestamp": time.time(),
+                "seq": self.last_seq
+            })
             for client in self.active_sockets:
-                await client.queue.put({
-                    "message_type": "heartbeat",
-                    "timestamp": timestamp
-                })
+                client.queue.put_nowait(frame)
 
 if __name__ == "__main__":
     from certstream.watcher import TransparencyWatcher
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+from certstream.metrics import serve_metrics
+from certstream.relay import FramePublisher, RelayWatcher
+from certstream.util import run_until_signalled
+from certstream.watcher import TransparencyWatcher
+from certstream.webserver import WebServer
+
+
+class WorkerStats(object):
+    """
+    A slot per websocket worker in an anonymous shared memory array, so whichever worker answers /stats
+    can report on all of them.
+    """
+    FIELDS = ('pid', 'connected_client_count', 'queued_messages', 'queued_bytes', 'updated')
+
+    def __init__(self, worker_count, context=multiprocessing):
+        self.worker_count = worker_count
+        self.values = context.Array('d', worker_count * len(self.FIELDS), lock=False)
+
+    def update(self, worker_id, connected_client_count, queued_messages, queued_bytes):
+        offset = worker_id * len(self.FIELDS)
+        self.values[offset:offset + len(self.FIELDS)] = [
+            os.getpid(), connected_client_count, queued_messages, queued_bytes, time.time()
+        ]
+
+    def snapshot(self):
+        workers = []
+        for worker_id in range(self.worker_count):
+            offset = worker_id * len(self.FIELDS)
+            worker = dict(zip(self.FIELDS, self.values[offset:offset + len(self.FIELDS)]))
+            for field in ('pid', 'connected_client_count', 'queued_messages', 'queued_bytes'):
+                worker[field] = int(worker[field])
+            worker['worker_id'] = worker_id
+            workers.append(worker)
+        return workers
+
+
+def _run_worker(worker_id, relay_address, worker_stats):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    watcher = RelayWatcher(loop, relay_address)
+    webserver = WebServer(loop, watcher, worker_stats=worker_stats, worker_id=worker_id)
+
+    asyncio.ensure_future(asyncio.gather(*watcher.get_tasks()))
+
+    webserver.run_server(reuse_port=True)
+
+
+class WorkerSupervisor(object):
+    """
+    Runs the watcher in this process and WEB_WORKERS websocket servers in child processes, all listening
+    on the same port through SO_REUSEPORT. Certificates are encoded once here and handed to the workers
+    over a private unix socket with the same framing an ingest node uses.
+
+    Workers are spawned rather than forked. A worker that dies is restarted from a process that by then
+    has a running loop, parsing pool threads and open sockets, none of which a forked child could safely
+    inherit.
+    """
+    def __init__(self, worker_count):
+        self.logger = logging.getLogger('certstream.workers')
+        self.worker_count = worker_count
+        self.context = multiprocessing.get_context('spawn')
+        self.relay_address = "unix:{}".format(os.path.join(tempfile.mkdtemp(prefix='certstream-'), 'relay.sock'))
+        self.worker_stats = WorkerStats(worker_count, self.context)
+        self.processes = [None] * worker_count
+
+    def _start_worker(self, worker_id):
+        process = self.context.Process(
+            target=_run_worker,
+            args=(worker_id, self.relay_address, self.worker_stats),
+            name='certstream-worker-{}'.format(worker_id),
+            daemon=True,
+        )
+        process.start()
+        self.processes[worker_id] = process
+        self.logger.info("Started websocket worker {} (pid {})".format(worker_id, process.pid))
+
+    async def supervise(self):
+        while True:
+            await asyncio.sleep(5)
+            for worker_id, process in enumerate(self.processes):
+                if not process.is_alive():
+                    self.logger.warning("Websocket worker {} exited with {}, restarting".format(worker_id, process.exitcode))
+                    self._start_worker(worker_id)
+
+    def run(self):
+        for worker_id in range(self.worker_count):
+            self._start_worker(worker_id)
+
+        loop = asyncio.get_event_loop()
+
+        watcher = TransparencyWatcher(loop)
+        publisher = FramePublisher(loop, watcher, self.relay_address)
+
+        try:
+            run_until_signalled(loop, publisher.get_tasks() + watcher.get_tasks() + [self.supervise(), serve_metrics(loop)])
+        finally:
+            watcher.checkpoints.flush()
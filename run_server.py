@@ -1,3 +1,5 @@
 import certstream
 
-certstream.run()
\ No newline at end of file
+# Websocket workers (WEB_WORKERS) are spawned, which imports this module again in each of them
+if __name__ == "__main__":
+    certstream.run()
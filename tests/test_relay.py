@@ -0,0 +1,74 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from certstream.messages import EncodedCertificate, StreamQueue
+from certstream.relay import FRAME_HEADER, FramePublisher
+
+
+class RecordingWatcher(object):
+    def __init__(self):
+        self.stream = StreamQueue()
+        self.checkpointed = []
+
+    def done(self, record):
+        self.checkpointed.append(record.cert_index)
+
+
+def record(index):
+    return EncodedCertificate({
+        "update_type": "X509LogEntry",
+        "leaf_cert": {"all_domains": ["example.com"], "extensions": {}, "serial_number": "{:x}".format(index)},
+        "chain": [],
+        "cert_index": index,
+        "seen": 1.0,
+        "source": {"url": "log.example", "name": "Example log"},
+    })
+
+
+class FramePublisherTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.directory = tempfile.mkdtemp()
+        self.watcher = RecordingWatcher()
+        self.publisher = FramePublisher(self.loop, self.watcher, address='unix:' + os.path.join(self.directory, 'relay.sock'))
+
+    def tearDown(self):
+        self.publisher.server.close()
+        self.loop.close()
+        shutil.rmtree(self.directory)
+
+    def test_nothing_checkpointed_without_subscribers(self):
+        async def scenario():
+            await self.publisher.serve()
+            publishing = asyncio.ensure_future(self.publisher.publish_stream())
+
+            for index in range(3):
+                await self.watcher.stream.put(record(index))
+            await asyncio.sleep(0.1)
+
+            # Nobody to send them to, so they stay on the stream and the checkpoint stays put
+            self.assertEqual(self.watcher.checkpointed, [])
+            self.assertEqual(self.watcher.stream.qsize(), 3)
+
+            reader, writer = await asyncio.open_unix_connection(self.publisher.address[len('unix:'):])
+            received = []
+            for _ in range(3):
+                length, seq, seen = FRAME_HEADER.unpack(await asyncio.wait_for(reader.readexactly(FRAME_HEADER.size), 5))
+                received.append(json.loads((await reader.readexactly(length)).decode('utf-8'))['cert_index'])
+
+            self.assertEqual(received, [0, 1, 2])
+            self.assertEqual(self.watcher.checkpointed, [0, 1, 2])
+
+            writer.close()
+            publishing.cancel()
+
+        self.loop.run_until_complete(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()